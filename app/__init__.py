@@ -1,9 +1,14 @@
+import atexit
 import logging
+import os
 import sys
+import threading
+from contextlib import contextmanager
 from pathlib import Path
 
 import psycopg2
 import yaml
+from psycopg2.pool import ThreadedConnectionPool
 
 with open("resources/config.yaml") as yaml_config:
     config = yaml.safe_load(yaml_config)
@@ -40,9 +45,77 @@ def init_paths(conf, path_key):
 init_paths(config, 'path')
 
 
+connection_pool = None
+connection_pool_process = None
+connection_slots = None
+connection_pool_lock = threading.Lock()
+
+
+@contextmanager
 def get_connection():
+    """Checks a connection out of the process wide pool, waiting while all of them are in use"""
+    pool = __get_connection_pool()
+    connection_slots.acquire()
     try:
-        return psycopg2.connect(config['postgres']['connection'])
+        connection = pool.getconn()
+        replaced = 0
+        while not __healthy_connection(connection):
+            pool.putconn(connection, close=True)
+            # every idle connection may have gone stale, after which even new connections are unhealthy
+            if replaced == config['postgres']['pool']['max-size']:
+                logging.error("There was a problem getting a healthy connection to the PostgreSQL database")
+                raise psycopg2.OperationalError("No healthy connection after replacing '{}'".format(replaced))
+            logging.debug("Replacing an unhealthy PostgreSQL connection")
+            connection = pool.getconn()
+            replaced += 1
+        try:
+            yield connection
+        finally:
+            pool.putconn(connection)  # rolls back anything left uncommitted
+    finally:
+        connection_slots.release()
+
+
+def __get_connection_pool() -> ThreadedConnectionPool:
+    global connection_pool, connection_pool_process, connection_slots
+    if connection_pool is None or connection_pool_process != os.getpid():  # connections can't be shared with forks
+        with connection_pool_lock:  # checked again so that threads arriving together create a single pool
+            if connection_pool is None or connection_pool_process != os.getpid():
+                pool_config = config['postgres']['pool']
+                try:
+                    pool = ThreadedConnectionPool(pool_config['min-size'], pool_config['max-size'],
+                                                  config['postgres']['connection'])
+                except psycopg2.Error:
+                    logging.error("There was a problem connecting to the PostgreSQL database")
+                    raise
+                connection_slots = threading.BoundedSemaphore(pool_config['max-size'])
+                connection_pool_process = os.getpid()
+                connection_pool = pool
+                logging.debug("Created PostgreSQL connection pool of up to '{}' connections".format(
+                    pool_config['max-size']))
+    return connection_pool
+
+
+def __healthy_connection(connection) -> bool:
+    if connection.closed:
+        return False
+    if not config['postgres']['pool']['health-check']:
+        return True
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        connection.rollback()
+        return True
     except psycopg2.Error:
-        logging.error("There was a problem connecting to the PostgreSQL database")
-        raise
+        return False
+
+
+def close_connections():
+    global connection_pool
+    if connection_pool is not None and connection_pool_process == os.getpid():
+        connection_pool.closeall()
+        logging.debug("Closed PostgreSQL connection pool")
+    connection_pool = None
+
+
+atexit.register(close_connections)
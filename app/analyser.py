@@ -1,9 +1,10 @@
 import calendar
 import datetime
 import logging
-from typing import List, Dict
+import time
+from typing import List, Dict, Union, Tuple
 
-import chart_studio
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 import plotly.io as pio
@@ -11,7 +12,10 @@ from pandas import DataFrame
 from scipy.stats import ttest_ind, levene, shapiro, mannwhitneyu
 
 from app import config, secrets
+from app.sales_batch import SalesBatch, full_price_flag, vat_exclusive_flag, new_flag
+from app.sketches import SketchStore, QuantileSketch
 from app.transformer import TransformedPropertySale
+from app.util import plots
 
 pd.set_option('display.float_format', lambda x: '%.3f' % x)
 pd.set_option('display.max_columns', 100)
@@ -19,86 +23,149 @@ pd.set_option('display.width', 200)
 pd.set_option('display.max_rows', 1000)
 
 pio.templates.default = config['plotly']['template']
-chart_studio.tools.set_credentials_file(username=config['plotly']['chart-studio']['username'],
-                                        api_key=secrets['api-key']['chart-studio'])
+
+cube_keys = ['date', 'county', 'new', 'full_price']
+descriptive_statistics = ['count', 'sum', 'mean', 'median', 'std', 'var', 'sem', 'min', 'max']
+# those grouped from the prices for each descriptive rather than rolled up from the cube
+grouped_statistics = ['sum', 'mean', 'median', 'std', 'var', 'sem']
+# name, flags every sale must have and grouping, with the year grouped under the name of the date it comes from
+descriptive_rollups = [
+    ('overall', (), []),
+    ('full_price', ('full_price',), []),
+    ('county', (), ['county']),
+    ('new', ('new',), []),
+    ('full_price_per_county', ('full_price',), ['county']),
+    ('new_per_county', ('new',), ['county']),
+    ('full_price_new', ('new', 'full_price'), []),
+    ('year', (), ['date']),
+    ('full_price_per_year', ('full_price',), ['date']),
+    ('new_per_year', ('new',), ['date']),
+    ('full_price_new_per_year', ('new', 'full_price'), ['date']),
+    ('county_per_year', (), ['date']),  # only ever grouped by year
+    ('full_price_per_county_per_year', ('full_price',), ['date', 'county']),
+    ('full_price_new_per_county_per_year', ('new', 'full_price'), ['date', 'county'])
+]
 
 
 class Analyser:
 
-    def __init__(self, property_sales: List[TransformedPropertySale]):
-        self.property_sales = property_sales
-        self.data_frame = self.__pandas_setup()
+    def __init__(self, property_sales: Union[List[TransformedPropertySale], SalesBatch]):
+        # only the frame is kept, the sales are left for the caller to release
+        self.data_frame = self.__pandas_setup(property_sales)
         self.plots: List[Dict] = []
+        self.month_keys: Dict[str, pd.Series] = None
+        self.groupings: Dict[Tuple, DataFrame] = {}
 
     def log_totals(self):
-        logging.info("sales: '{}'".format(len(self.property_sales)))
-        logging.info("new property sales: '{}'".format(
-            self.__count_with_lambda(lambda sale: sale.new, self.property_sales)))
-        logging.info("non-new property sales: '{}'".format(
-            self.__count_with_lambda(lambda sale: not sale.new, self.property_sales)))
-        logging.info("full price property sales: '{}'".format(
-            self.__count_with_lambda(lambda sale: sale.full_price, self.property_sales)))
-        logging.info("non-full price property sales: '{}'".format(
-            self.__count_with_lambda(lambda sale: not sale.full_price, self.property_sales)))
-        logging.info("vat exclusive property sales: '{}'".format(
-            self.__count_with_lambda(lambda sale: sale.vat_exclusive, self.property_sales)))
-        logging.info("vat inclusive property sales: '{}'".format(
-            self.__count_with_lambda(lambda sale: not sale.vat_exclusive, self.property_sales)))
+        total = len(self.data_frame)
+        new, full_price, vat_exclusive = (int(self.data_frame[column].sum())
+                                          for column in ['new', 'full_price', 'vat_exclusive'])
+        logging.info("sales: '{}'".format(total))
+        logging.info("new property sales: '{}'".format(new))
+        logging.info("non-new property sales: '{}'".format(total - new))
+        logging.info("full price property sales: '{}'".format(full_price))
+        logging.info("non-full price property sales: '{}'".format(total - full_price))
+        logging.info("vat exclusive property sales: '{}'".format(vat_exclusive))
+        logging.info("vat inclusive property sales: '{}'".format(total - vat_exclusive))
 
     @classmethod
-    def __count_with_lambda(cls, lambda_func, sales: List[TransformedPropertySale]) -> int:
-        return len(list(filter(lambda_func, sales)))
-
-    def __pandas_setup(self) -> DataFrame:
-        dict_property_sales = [{
-            'date': sale.date, 'county': sale.county, 'price': sale.price, 'full_price': sale.full_price,
-            'vat_exclusive': sale.vat_exclusive, 'new': sale.new, 'size': sale.size
-        } for sale in self.property_sales]
-        data_frame = pd.DataFrame(data=dict_property_sales)
-        data_frame['price'] = pd.to_numeric(data_frame['price'])
-        data_frame['date'] = pd.to_datetime(data_frame['date'])
+    def __pandas_setup(cls, property_sales: Union[List[TransformedPropertySale], SalesBatch]) -> DataFrame:
+        start = time.perf_counter()
+        if not isinstance(property_sales, SalesBatch):
+            # gathered into typed columns first rather than a frame of per sale dicts holding Decimals and dates
+            property_sales = SalesBatch.from_sales(property_sales)
+        data_frame = cls.__pandas_setup_from_batch(property_sales)
+        logging.info("Built analysis frame of '{}' sales in '{:.3f}'s using '{}' bytes".format(
+            len(data_frame), time.perf_counter() - start, int(data_frame.memory_usage(deep=True).sum())))
         return data_frame
 
+    @classmethod
+    def __pandas_setup_from_batch(cls, batch: SalesBatch) -> DataFrame:
+        flags = np.frombuffer(batch.flags, dtype=np.uint8)
+        epoch = datetime.date(1970, 1, 1).toordinal()
+        return pd.DataFrame({
+            'date': pd.to_datetime((np.frombuffer(batch.dates, dtype=np.int32) - epoch).astype('datetime64[D]')),
+            'county': cls.__categorical(batch.counties, batch.county_category.values),
+            'price': np.frombuffer(batch.prices, dtype=np.int64) / 100,
+            'full_price': (flags & full_price_flag) != 0,
+            'vat_exclusive': (flags & vat_exclusive_flag) != 0,
+            'new': (flags & new_flag) != 0,
+            'size': cls.__categorical(batch.sizes, batch.size_category.values)
+        })
+
+    @classmethod
+    def __categorical(cls, codes, values: List[str]) -> pd.Categorical:
+        # categories sorted so that grouping orders them the same as plain strings
+        return pd.Categorical.from_codes(np.frombuffer(codes, dtype=np.uint16), categories=values) \
+            .reorder_categories(sorted(values))
+
     def get_descriptives(self) -> List[Dict]:
-        dicts = [{'name': 'overall', 'data': self.__format_descriptives(self.data_frame)},
-                 {'name': 'full_price', 'data': self.__format_descriptives(self.data_frame[self.data_frame['full_price']])},
-                 {'name': 'county', 'data': self.__format_descriptives(self.data_frame.groupby('county'))},
-                 {'name': 'new', 'data': self.__format_descriptives(self.data_frame[self.data_frame['new']])},
-                 {'name': 'full_price_per_county',
-                  'data': self.__format_descriptives(self.data_frame[self.data_frame['full_price'] == True].groupby('county'))},
-                 {'name': 'new_per_county',
-                  'data': self.__format_descriptives(self.data_frame[self.data_frame['new'] == True].groupby('county'))},
-                 {'name': 'full_price_new',
-                  'data': self.__format_descriptives(self.data_frame[(self.data_frame['new'] == True) & (self.data_frame['full_price'] == True)])},
-                 {'name': 'year',
-                  'data': self.__format_descriptives(self.data_frame.groupby(self.data_frame['date'].map(lambda x: x.year)))},
-                 {'name': 'full_price_per_year',
-                  'data': self.__format_descriptives(self.data_frame[self.data_frame['full_price'] == True].groupby(self.data_frame['date'].map(lambda x: x.year)))},
-                 {'name': 'new_per_year',
-                  'data': self.__format_descriptives(self.data_frame[self.data_frame['new'] == True].groupby(self.data_frame['date'].map(lambda x: x.year)))},
-                 {'name': 'full_price_new_per_year',
-                  'data': self.__format_descriptives(self.data_frame[(self.data_frame['new'] == True) & (self.data_frame['full_price'] == True)].groupby(self.data_frame['date'].map(lambda x: x.year)))},
-                 {'name': 'county_per_year',
-                  'data': self.__format_descriptives(self.data_frame.groupby([self.data_frame['date'].map(lambda x: x.year)]))},
-                 {'name': 'full_price_per_county_per_year',
-                  'data': self.__format_descriptives(self.data_frame[self.data_frame['full_price'] == True].groupby([self.data_frame['date'].map(lambda x: x.year), 'county']))},
-                 {'name': 'full_price_new_per_county_per_year', 'data': self.__format_descriptives(self.data_frame[(self.data_frame['new'] == True) & (self.data_frame['full_price'] == True)].groupby([self.data_frame['date'].map(lambda x: x.year), 'county']))}]
-        return dicts
+        """Aggregates the sales once by year, county, new and full price, then rolls each descriptive up from that.
+
+        Only the count, minimum and maximum are rolled up. The other statistics are grouped directly from the prices
+        for each descriptive, as rolling them up changes their last digits in the published csv files.
+        """
+        keys = DataFrame({'date': self.data_frame['date'].dt.year, 'county': self.data_frame['county'],
+                          'new': self.data_frame['new'], 'full_price': self.data_frame['full_price']})
+        cells = self.data_frame['price'].groupby([keys[key] for key in cube_keys], observed=True) \
+            .agg(['count', 'min', 'max']).reset_index()
+        masks = {(): None, ('full_price',): keys['full_price'], ('new',): keys['new'],
+                 ('new', 'full_price'): keys['new'] & keys['full_price']}
+        return [{'name': name, 'data': self.__rollup(cells, keys, masks[flags], flags, grouping)}
+                for name, flags, grouping in descriptive_rollups]
+
+    def __rollup(self, cells: DataFrame, keys: DataFrame, mask, flags, grouping: List[str]) -> DataFrame:
+        for flag in flags:
+            cells = cells[cells[flag]]
+        prices = self.data_frame['price'] if mask is None else self.data_frame['price'][mask]
+        if len(grouping) == 0:
+            cells = cells.assign(overall=0)
+        rolled = cells.groupby(grouping if len(grouping) != 0 else ['overall'], observed=True).agg(
+            count=('count', 'sum'), min=('min', 'min'), max=('max', 'max'))
+        if len(grouping) == 0:
+            direct = prices.agg(grouped_statistics)
+            for statistic in grouped_statistics:
+                rolled[statistic] = direct[statistic]
+            return DataFrame({'price': rolled[descriptive_statistics].iloc[0].astype(float)})
+        direct = prices.groupby([keys[key][prices.index] for key in grouping], observed=True).agg(grouped_statistics)
+        rolled = rolled.join(direct)
+        descriptives = rolled[descriptive_statistics]
+        descriptives.columns = pd.MultiIndex.from_product([['price'], descriptive_statistics])
+        return descriptives
 
     @classmethod
-    def __format_descriptives(cls, data_frame: DataFrame) -> DataFrame:
-        return data_frame.agg({'price': ['count', 'sum', 'mean', 'median', 'std', 'var', 'sem', 'min', 'max']})
+    def get_sketch_descriptives(cls, store: SketchStore) -> List[Dict]:
+        """Descriptives answered from the price sketches alone, each quantile within their relative accuracy"""
+        months = sorted(set(month for month, _, _, _ in store.cells))
+        counties = sorted(set(county for _, county, _, _ in store.cells))
+        return [{'name': 'sketch_per_month',
+                 'data': cls.__format_sketches('month', months, [store.merged(month=month) for month in months])},
+                {'name': 'sketch_per_county',
+                 'data': cls.__format_sketches('county', counties, [store.merged(county=county) for county in counties])}]
+
+    @classmethod
+    def __format_sketches(cls, index_name: str, index: List[str], sketches: List[QuantileSketch]) -> DataFrame:
+        return DataFrame({
+            'count': [sketch.count for sketch in sketches],
+            'sum': [sketch.sum for sketch in sketches],
+            'mean': [sketch.sum / sketch.count for sketch in sketches],
+            'p25': [sketch.quantile(0.25) for sketch in sketches],
+            'median': [sketch.quantile(0.5) for sketch in sketches],
+            'p75': [sketch.quantile(0.75) for sketch in sketches],
+            'min': [sketch.min for sketch in sketches],
+            'max': [sketch.max for sketch in sketches]
+        }, index=pd.Index(index, name=index_name))
 
     def time_analysis(self,):
         logging.debug("Plotting overall time series trend")
-        month_yearly_grouped = self.__group_price_by_month(self.data_frame)
+        month_yearly_grouped = self.__group_price_by_month()
         month_yearly_figure = go.Figure(
             data=go.Scatter(x=month_yearly_grouped['date'], y=month_yearly_grouped['price_median'],
                             mode='lines', line={'width': 4}))
         month_yearly_figure.update_layout(title='Overall Property Sales Prices (Median per Month)', xaxis_title='Date',
                                           yaxis_title='Price (€)')
         self.plots.append({'name': 'irish_property_sales_prices_median_per_month_year', 'figure': month_yearly_figure})
-        monthly_grouped = self.__group_price_by_month(self.data_frame, map_func=lambda raw_date: raw_date.month)
+        monthly_grouped = self.__group_price_by_month(key='calendar_month')
         monthly_grouped['label'] = monthly_grouped['date'].transform(lambda month_int: calendar.month_name[month_int])
         monthly_grouped['colour'] = 'paleturquoise'
         monthly_grouped.loc[3:6, 'colour'] = 'orange'
@@ -112,21 +179,37 @@ class Analyser:
                                      xaxis={'title': 'Price (€)'}, yaxis={'title': 'Month', 'autorange': 'reversed'})
         self.plots.append({'name': 'irish_property_sales_prices_median_per_month', 'figure': monthly_figure})
 
-    @classmethod
-    def __group_price_by_month(cls, data_frame: DataFrame, sort_grouping=True, aggregation='median',
-                                      map_func=lambda raw_date: datetime.datetime(month=raw_date.month,
-                                                                                  year=raw_date.year,
-                                                                                  day=1)) -> DataFrame:
-        grouped = data_frame.groupby([data_frame['date'].map(map_func)], sort=sort_grouping) \
-            .agg({'price': [aggregation]}).reset_index()
-        grouped.columns = ['_'.join(col).rstrip('_') for col in grouped.columns.values]
+    def __group_price_by_month(self, new: bool = None, key: str = 'month', aggregation: str = 'median') -> DataFrame:
+        """Median or count of the prices per month of the sales, or of only the new or existing ones.
+
+        Each subset of the sales is grouped once for both aggregations and reused by every later plot or test. The key
+        is either the month of the year or just the calendar month.
+        """
+        if (new, key) not in self.groupings:
+            months = self.__month_keys()[key]
+            prices = self.data_frame['price']
+            if new is not None:
+                mask = self.data_frame['new'] == new
+                months, prices = months[mask], prices[mask]
+            self.groupings[(new, key)] = prices.groupby(months).agg(['median', 'count'])
+        grouped = self.groupings[(new, key)][[aggregation]].reset_index()
+        grouped.columns = ['date', 'price_' + aggregation]
         return grouped
 
+    def __month_keys(self) -> Dict[str, pd.Series]:
+        if self.month_keys is None:
+            months = self.data_frame['date'].values.astype('datetime64[M]')
+            self.month_keys = {
+                'month': pd.Series(months.astype('datetime64[ns]'), index=self.data_frame.index, name='date'),
+                'calendar_month': pd.Series(months.astype(np.int64) % 12 + 1, index=self.data_frame.index, name='date')
+            }
+        return self.month_keys
+
     def new_old_analysis(self):
         logging.info("Analysing newly-built vs existing property sales using monthly medians")
-        new = self.__group_price_by_month(self.data_frame[(self.data_frame['new'] == True)])
-        old = self.__group_price_by_month(self.data_frame[(self.data_frame['new'] == False)])
-        distribution = self.__group_price_by_month(self.data_frame)
+        new = self.__group_price_by_month(new=True)
+        old = self.__group_price_by_month(new=False)
+        distribution = self.__group_price_by_month()
         # hist_fig = px.histogram(distribution, x='price_median')
         # hist_fig.show()
         shapiro_tests = [shapiro(distribution['price_median'][(self.data_frame['new'] == cond)]) for cond in [True, False]]
@@ -151,7 +234,7 @@ class Analyser:
         fig.update_layout(title='New & Existing Property Sales Prices (Median per Month)',
                           xaxis_title='Date', yaxis_title='Price (€)')
         self.plots.append({'name': 'new_v_existing_irish_property_sales_prices_median_per_month_year', 'figure': fig})
-        count_new = self.__group_price_by_month(self.data_frame[(self.data_frame['new'] == True)], aggregation='count')
+        count_new = self.__group_price_by_month(new=True, aggregation='count')
         count_fig = go.Figure()
         count_fig.add_trace(go.Scatter(x=new['date'], y=count_new['price_count'], mode='lines', line={'width': 4}))
         count_fig.update_layout(title='New Properties Sold (per Month)', xaxis_title='Date',
@@ -159,14 +242,19 @@ class Analyser:
         self.plots.append({'name': 'new_irish_property_sales_count_per_month_year', 'figure': count_fig})
 
     def output_plots(self):
-        for plot in self.plots:
-            plot['figure'].write_html(config['analysis']['plots']['output']['path'] + plot['name'] + ".html")
+        output_config = config['analysis']['plots']['output']
+        written = plots.export_html(self.plots, output_config['path'], shared_plotlyjs=output_config['shared-plotlyjs'],
+                                    skip_unchanged=output_config['skip-unchanged'], workers=output_config['workers'])
+        logging.info("Exported '{}' changed plots of '{}'".format(written, len(self.plots)))
 
     def show_plots(self):
         for plot in self.plots:
             plot['figure'].show()
 
     def upload_plots_to_chart_studio(self):
+        import chart_studio  # only imported and signed in to when uploading
+        chart_studio.tools.set_credentials_file(username=config['plotly']['chart-studio']['username'],
+                                                api_key=secrets['api-key']['chart-studio'])
         for plot in self.plots:
             chart_studio.plotly.plot(plot['figure'], filename=plot['name'])
 
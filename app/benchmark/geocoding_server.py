@@ -0,0 +1,70 @@
+import argparse
+import json
+import logging
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from zlib import crc32
+
+
+class NominatimStandIn(BaseHTTPRequestHandler):
+    """Answers Nominatim searches after a fixed latency, so the geocoding engine can be run without a real server.
+
+    Roughly one address in ten has no result. Once the quota of requests is used up every search gets a 429, which
+    geopy raises as a quota exceeded error.
+    """
+    latency = 0.05
+    quota = -1
+    requests = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/search":
+            self.send_error(404)
+            return
+        with self.lock:
+            NominatimStandIn.requests += 1
+            over_quota = self.quota != -1 and self.requests > self.quota
+        time.sleep(self.latency)
+        if over_quota:
+            self.send_error(429)
+            return
+        address = parse_qs(url.query).get('q', [''])[0]
+        key = crc32(address.encode('utf-8'))
+        results = [] if key % 10 == 0 else [{
+            'place_id': key, 'osm_type': 'way', 'osm_id': key, 'class': 'building', 'type': 'house',
+            'importance': 0.5, 'display_name': address, 'lat': str(51.5 + (key % 1000) / 400),
+            'lon': str(-10.0 + (key // 1000 % 1000) / 250), 'boundingbox': ['51.5', '55.4', '-10.0', '-6.0']
+        }]
+        body = json.dumps(results).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+def serve(port: int, latency: float, quota: int) -> ThreadingHTTPServer:
+    NominatimStandIn.latency = latency
+    NominatimStandIn.quota = quota
+    NominatimStandIn.requests = 0
+    server = ThreadingHTTPServer(('localhost', port), NominatimStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local stand-in for a Nominatim geocoding server")
+    parser.add_argument('--port', type=int, default=7070)
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds taken to answer each search")
+    parser.add_argument('--quota', type=int, default=-1, help="searches answered before returning 429s")
+    arguments = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    serve(arguments.port, arguments.latency, arguments.quota)
+    logging.info("Serving Nominatim searches on port '{}'".format(arguments.port))
+    threading.Event().wait()
@@ -0,0 +1,69 @@
+import itertools
+import json
+import logging
+import statistics
+import subprocess
+import sys
+from typing import List, Dict
+
+import app.geocoding as geocoding_providers
+from app import config
+
+stages = ['get-raw-data', 'clean-data', 'analyse', 'geocode']
+# what main imports at startup before any stage runs
+main_modules = ['app.cleaner', 'app.property_price_register', 'app.metrics', 'app.util.iteration', 'app.sales_batch',
+                'app.transformer',
+                'app.parquet_storage' if config['storage']['backend'] == 'parquet' else 'app.storage']
+# the modules everything was imported from before the stages imported their own
+eager_modules = ['app.analyser', 'app.cleaner', 'app.columnar_cleaner', 'app.geocoder', 'app.sketches',
+                 'chart_studio'] + [provider['implementation'].rsplit('.', 1)[0]
+                                    for provider in geocoding_providers.providers]
+
+
+def stage_modules(stage: str) -> List[str]:
+    """The modules main imports once the stage runs, given the current config"""
+    if stage == 'clean-data':
+        modules = ['app.columnar_cleaner'] if config['data_clean']['engine']['type'] == 'columnar' else []
+        return modules + ['app.sketches'] if config['analysis']['sketches']['enabled'] else modules
+    if stage == 'analyse':
+        return ['app.analyser', 'chart_studio'] if config['analysis']['plots']['upload']['enabled'] \
+            else ['app.analyser']
+    if stage == 'geocode':
+        return ['app.geocoder', 'app.geocoding'] + list(geocoding_providers.enabled_modules())
+    return []
+
+
+def run() -> Dict[str, float]:
+    """Times a fresh interpreter importing what each combination of stages needs, against importing everything"""
+    repeats = config['benchmark']['startup']['repeats']
+    results = {'eager': __time_imports(main_modules + eager_modules, repeats)}
+    for size in range(1, len(stages) + 1):
+        for combination in itertools.combinations(stages, size):
+            modules = main_modules + [module for stage in combination for module in stage_modules(stage)]
+            results['+'.join(combination)] = __time_imports(modules, repeats)
+    for name, seconds in results.items():
+        logging.info("Startup for '{}' took '{:.3f}'s".format(name, seconds))
+    output_file = config['benchmark']['output']['path'] + "startup.json"
+    try:
+        with open(output_file, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=4)
+    except IOError:
+        logging.error("Unable to process file '{}'".format(output_file))
+        raise ValueError("There was an issue writing to the file '{}'".format(output_file))
+    return results
+
+
+def __time_imports(modules: List[str], repeats: int) -> float:
+    # a fresh interpreter each time so nothing is already imported, the median taken to smooth out the noise
+    script = "import time\nstart = time.perf_counter()\nimport app\n" + \
+             "".join("import {}\n".format(module) for module in dict.fromkeys(modules)) + \
+             "print(time.perf_counter() - start)"
+    timings = []
+    for _ in range(repeats):
+        completed = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+        timings.append(float(completed.stdout.strip().splitlines()[-1]))
+    return statistics.median(timings)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,135 @@
+import copy
+import json
+import logging
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import app.cleaner as cleaner
+import app.property_price_register as price_register
+import app.transformer as transformer
+from app import config
+from app.benchmark import synthetic
+from app.sanitiser import Sanitiser
+
+benchmark_config = config['benchmark']
+
+
+def run() -> List[str]:
+    """Benchmarks each stage over a synthetic register, stores the results and returns any throughput regressions"""
+    output_path = benchmark_config['output']['path']
+    rows = benchmark_config['rows']
+    csv_file = "{}synthetic_{}_{}.csv".format(output_path, rows, benchmark_config['seed'])
+    if not Path(csv_file).exists():
+        synthetic.generate_csv(csv_file, rows, seed=benchmark_config['seed'])
+    price_register.output_file = csv_file
+    results = {}
+    raw_sales = __benchmark(results, 'parse_csv', rows, lambda: None, lambda _: price_register.parse_csv())
+    __benchmark(results, 'sanitise', rows, lambda: __fresh_sanitiser(raw_sales), Sanitiser.sanitise_sales)
+    addresses = [(sale.address, sale.postcode, sale.county) for sale in raw_sales]
+    __benchmark(results, 'transform_address', rows, transformer.transform_address.cache_clear,
+                lambda _: [transformer.transform_address(*address) for address in addresses])
+    for engine in ['row', 'columnar']:
+        batch = __benchmark(results, 'clean_' + engine, rows, lambda: __fresh_sanitiser(raw_sales),
+                            lambda sales: cleaner.clean_chunk(sales, True, engine))
+    __benchmark_analysis(results, batch)
+    if benchmark_config['postgres']['enabled']:
+        __benchmark_postgres(results, raw_sales, batch)
+    if benchmark_config['mongo']['enabled']:
+        __benchmark_mongo(results, batch)
+    return __store(results)
+
+
+def __benchmark(results: Dict, name: str, rows: int, setup: Callable, function: Callable):
+    """Runs function on the output of setup the configured number of times, keeping the fastest"""
+    best = None
+    output = None
+    for _ in range(benchmark_config['repeats']):
+        argument = setup()
+        start = time.perf_counter()
+        output = function(argument)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    results[name] = {'rows': rows, 'seconds': best, 'rows_per_second': rows / best if best > 0 else None}
+    logging.info("Benchmark '{}' took '{:.3f}'s ('{:.0f}' rows/sec)".format(name, best, rows / best if best else 0))
+    return output
+
+
+def __fresh_sanitiser(raw_sales):
+    # the sanitiser updates sales in place and caches lookups, so every repeat starts from scratch
+    for lookup in Sanitiser.lookups.values():
+        lookup.clear()
+    Sanitiser.anomalies.clear()
+    transformer.transform_address.cache_clear()
+    return [copy.copy(sale) for sale in raw_sales]
+
+
+def __benchmark_analysis(results: Dict, batch):
+    import app.analyser as analysis
+    analyser = __benchmark(results, 'analyser_setup', len(batch), lambda: batch, analysis.Analyser)
+    __benchmark(results, 'analyser_descriptives', len(batch), lambda: analyser, lambda setup: setup.get_descriptives())
+
+
+def __benchmark_postgres(results: Dict, raw_sales, batch):
+    import app.storage as storage
+    config['postgres']['connection'] = benchmark_config['postgres']['connection']
+    config['storage']['table'] = {'raw': 'benchmark_raw_property_sales',
+                                  'transformed': 'benchmark_transformed_property_sales'}
+    config['storage']['ingest']['mode'] = 'replace'
+    for loader in ['insert', 'copy']:
+        config['storage']['loader']['type'] = loader
+        __benchmark(results, 'persist_raw_' + loader, len(raw_sales), lambda: raw_sales, storage.persist_raw_sales)
+        __benchmark(results, 'persist_transformed_' + loader, len(batch), lambda: batch,
+                    storage.persist_transformed_sales)
+    __benchmark(results, 'read_transformed_batch', len(batch), lambda: None,
+                lambda _: storage.read_transformed_sales_batch())
+
+
+def __benchmark_mongo(results: Dict, batch):
+    config['mongo']['connection'] = benchmark_config['mongo']['connection']
+    config['geocoding']['database'] = benchmark_config['mongo']['database']
+    import app.geocoder as geocoding
+    __benchmark(results, 'register_addresses', len(batch), lambda: geocoding.get_collection().drop(),
+                lambda _: geocoding.update_addresses(batch.addresses))
+
+
+def __store(results: Dict) -> List[str]:
+    results_file = benchmark_config['output']['path'] + "results.json"
+    try:
+        with open(results_file, 'r', encoding='utf-8') as file:
+            history = json.load(file)
+    except (IOError, ValueError):
+        history = []
+    regressions = __regressions(results, [run for run in history if run['rows'] == benchmark_config['rows']])
+    history.append({'timestamp': datetime.now().isoformat(), 'rows': benchmark_config['rows'], 'results': results})
+    try:
+        with open(results_file, 'w', encoding='utf-8') as file:
+            json.dump(history, file, indent=4)
+    except IOError:
+        logging.error("Unable to process file '{}'".format(results_file))
+        raise ValueError("There was an issue writing to the file '{}'".format(results_file))
+    return regressions
+
+
+def __regressions(results: Dict, history: List[Dict]) -> List[str]:
+    """Compares each throughput with the previous run of the same size"""
+    if len(history) == 0:
+        return []
+    previous = history[-1]['results']
+    tolerance = benchmark_config['regression-tolerance']
+    regressions = []
+    for name, result in results.items():
+        if name not in previous or not previous[name]['rows_per_second'] or not result['rows_per_second']:
+            continue
+        change = result['rows_per_second'] / previous[name]['rows_per_second'] - 1
+        if change < -tolerance:
+            regressions.append(name)
+            logging.warning("Benchmark '{}' regressed by '{:.1%}' to '{:.0f}' rows/sec".format(
+                name, -change, result['rows_per_second']))
+    return regressions
+
+
+if __name__ == '__main__':
+    sys.exit(1 if len(run()) != 0 else 0)
@@ -0,0 +1,104 @@
+import csv
+import datetime
+import logging
+import random
+from typing import List
+
+header = ["Date of Sale (dd/mm/yyyy)", "Address", "Postal Code", "County", "Price (€)", "Not Full Market Price",
+          "VAT Exclusive", "Description of Property", "Property Size Description"]
+
+counties = ["Carlow", "Cavan", "Clare", "Cork", "Donegal", "Dublin", "Galway", "Kerry", "Kildare", "Kilkenny", "Laois",
+            "Leitrim", "Limerick", "Longford", "Louth", "Mayo", "Meath", "Monaghan", "Offaly", "Roscommon", "Sligo",
+            "Tipperary", "Waterford", "Westmeath", "Wexford", "Wicklow"]
+# rough share of the register, Dublin has about a third of all sales
+county_weights = [1, 1, 2, 12, 3, 33, 6, 3, 5, 2, 2, 1, 4, 1, 3, 2, 4, 1, 1, 1, 1, 3, 2, 2, 3, 3]
+
+dublin_postcodes = ["Dublin {}".format(number) for number in range(1, 25)] + ["Dublin 6w"]
+irish_dublin_postcodes = ["Baile Átha Cliath {}".format(number) for number in range(1, 25)]
+
+descriptions = [("Second-Hand Dwelling house /Apartment", 80), ("New Dwelling house /Apartment", 17),
+                ("Teach/Árasán Cónaithe Atháimhe", 2), ("Teach/Árasán Cónaithe Nua", 1)]
+
+sizes = [("", 70), ("greater than or equal to 38 sq metres and less than 125 sq metres", 18),
+         ("greater than or equal to 125 sq metres", 5), ("less than 38 sq metres", 2),
+         ("greater than 125 sq metres", 1),
+         ("níos mó ná nó cothrom le 38 méadar cearnach agus níos lú ná 125 "
+          "méadar cearnach", 3),
+         ("níos lú ná 38 méadar cearnach", 1)]
+
+street_names = ["Main", "Church", "Bridge", "Mill", "Castle", "Green", "Oak", "Ash", "Beech", "Willow", "Hazel",
+                "Mountain", "River", "Abbey", "College", "Convent", "Fair", "Harbour", "Market", "Station", "Park",
+                "Seaview", "Hillside", "Orchard", "Cherry", "Ballymore", "Knock", "Kilbride", "Rath", "Dun"]
+street_types = ["Street", "St", "Road", "Rd", "Avenue", "Ave", "Park", "Pk", "Court", "Ct", "Drive", "Dr", "Lane",
+                "Ln", "Gardens", "Gdns", "Grove", "Grv", "Heights", "Hts", "Terrace", "Ter", "View", "Vw", "Close",
+                "Crescent", "Cres", "Lawn", "Manor", "Mnr", "Meadows", "Mdws", "Square", "Sq", "Upper", "Lwr"]
+towns = ["Ballincollig", "Swords", "Naas", "Bray", "Tralee", "Ennis", "Navan", "Carlow", "Athlone", "Mullingar",
+         "Letterkenny", "Castlebar", "Drogheda", "Dundalk", "Clonmel", "Gorey", "Tullamore", "Portlaoise", "Sligo",
+         "Kilkenny", "Balbriggan", "Malahide", "Douglas", "Salthill", "Oranmore", "Clane", "Maynooth", "Ratoath"]
+unit_prefixes = ["Apt", "Apartment", "Flat", "No", "No.", "Unit", "Apts"]
+
+
+def generate_csv(output_file: str, rows: int, seed: int = 42, resale_ratio: float = 0.3):
+    """Writes a cp1252 register like the published PPR-ALL.csv with rows sales in date order.
+
+    Roughly resale_ratio of the sales are resales of an earlier address, so address memoisation and geocoding
+    deduplication see the same kind of repetition as the real register.
+    """
+    generator = random.Random(seed)
+    sold: List[tuple] = []
+    start = datetime.date(2010, 1, 1)
+    days = (datetime.date(2020, 12, 31) - start).days
+    dates = sorted(start + datetime.timedelta(days=generator.randint(0, days)) for _ in range(rows))
+    with open(output_file, 'w', encoding='cp1252', newline='') as file:
+        writer = csv.writer(file, quoting=csv.QUOTE_ALL)
+        writer.writerow(header)
+        for date in dates:
+            if len(sold) != 0 and generator.random() < resale_ratio:
+                address, postcode, county = generator.choice(sold)
+            else:
+                county = generator.choices(counties, county_weights)[0]
+                address, postcode = __address(generator, county), __postcode(generator, county)
+                sold.append((address, postcode, county))
+            writer.writerow([date.strftime("%d/%m/%Y"), address, postcode, county, __price(generator, date),
+                             "No" if generator.random() < 0.95 else "Yes", "No" if generator.random() < 0.9 else "Yes",
+                             __weighted(generator, descriptions), __weighted(generator, sizes)])
+    logging.info("Generated '{}' synthetic property sales in '{}'".format(rows, output_file))
+
+
+def __address(generator: random.Random, county: str) -> str:
+    street = "{} {}".format(generator.choice(street_names), generator.choice(street_types))
+    town = generator.choice(towns)
+    roll = generator.random()
+    if roll < 0.1:  # multi-unit sales
+        first = generator.randint(1, 50)
+        numbers = ", ".join(str(first + offset) for offset in range(generator.randint(2, 4)))
+        address = "{} And {} {}".format(numbers, first + 5, street)
+    elif roll < 0.3:
+        address = "{} {}, {} {}".format(generator.choice(unit_prefixes), generator.randint(1, 120),
+                                        generator.randint(1, 200), street)
+    elif roll < 0.35:
+        address = "St. {}'s, {}".format(generator.choice(["Anne", "John", "Mary", "Patrick"]), street)
+    else:
+        address = "{} {}".format(generator.randint(1, 300), street)
+    address = "{}, {}, Co. {}".format(address, town, county) if generator.random() < 0.4 else \
+        "{}, {}".format(address, town)
+    return address.upper() if generator.random() < 0.15 else address
+
+
+def __postcode(generator: random.Random, county: str) -> str:
+    if county != "Dublin":
+        return "Ní Bhaineann" if generator.random() < 0.01 else ""
+    if generator.random() < 0.02:
+        return generator.choice(irish_dublin_postcodes)
+    return generator.choice(dublin_postcodes) if generator.random() < 0.8 else ""
+
+
+def __price(generator: random.Random, date: datetime.date) -> str:
+    # prices fall to 2013 and rise again afterwards
+    trend = 1.0 - 0.08 * min(date.year - 2010, 3) + 0.07 * max(date.year - 2013, 0)
+    price = max(5000.0, generator.lognormvariate(12.3, 0.5) * trend)
+    return "€{:,.2f}".format(round(price, 2))
+
+
+def __weighted(generator: random.Random, choices: List[tuple]) -> str:
+    return generator.choices([value for value, _ in choices], [weight for _, weight in choices])[0]
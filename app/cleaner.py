@@ -0,0 +1,70 @@
+import atexit
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from collections import Counter
+from typing import List, Tuple
+
+import app.transformer as transformer
+from app import config
+from app.property_price_register import RawPropertySale
+from app.sales_batch import SalesBatch
+from app.sanitiser import Sanitiser
+from app.util import iteration
+
+executor = None
+
+
+def clean(sales: List[RawPropertySale]) -> SalesBatch:
+    sanitise = config['data_clean']['sanitiser']['enabled']
+    engine = config['data_clean']['engine']['type']
+    parallel_config = config['data_clean']['parallel']
+    if parallel_config['enabled'] and len(sales) > parallel_config['chunk-size']:
+        cleaned = clean_parallel(sales, sanitise, engine, parallel_config['chunk-size'])
+    else:
+        cleaned = clean_chunk(sales, sanitise, engine)
+    return cleaned
+
+
+def clean_chunk(sales: List[RawPropertySale], sanitise: bool, engine: str = 'row') -> SalesBatch:
+    if engine == 'columnar':
+        import app.columnar_cleaner as columnar_cleaner  # keeps pandas out of row engine runs
+        return columnar_cleaner.clean(sales, sanitise)
+    # it could be nice to deep copy of raw property sales but didn't for efficiency and memory concerns
+    if sanitise:
+        sales = Sanitiser.sanitise_sales(sales)
+        logging.debug("Sanitised '{}' raw property sales".format(len(sales)))
+    sales = transformer.transformed_batch_from_raw(sales)
+    logging.debug("Transformed '{}' property sales".format(len(sales)))
+    return sales
+
+
+def clean_parallel(sales: List[RawPropertySale], sanitise: bool, engine: str, chunk_size: int) -> SalesBatch:
+    """Cleans chunks of the sales in worker processes, merging the results in their original order"""
+    chunks = iteration.batches(sales, chunk_size)
+    cleaned = SalesBatch()
+    for batch, anomalies in __get_executor().map(clean_worker_chunk, chunks, repeat(sanitise), repeat(engine)):
+        cleaned.extend_batch(batch)
+        Sanitiser.anomalies.update(anomalies)
+    logging.debug("Cleaned '{}' property sales across '{}' processes".format(
+        len(cleaned), config['data_clean']['parallel']['workers']))
+    return cleaned
+
+
+def clean_worker_chunk(sales: List[RawPropertySale], sanitise: bool, engine: str) -> Tuple[SalesBatch, Counter]:
+    # anomalies are counted in the worker so they are handed back to be logged with the rest
+    Sanitiser.anomalies.clear()
+    batch = clean_chunk(sales, sanitise, engine)
+    return batch, Counter(Sanitiser.anomalies)
+
+
+def log_anomalies():
+    Sanitiser.log_anomalies()
+
+
+def __get_executor() -> ProcessPoolExecutor:
+    global executor
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=config['data_clean']['parallel']['workers'])
+        atexit.register(executor.shutdown)
+    return executor
@@ -0,0 +1,172 @@
+import datetime
+import logging
+from operator import attrgetter
+from typing import List, Dict, Sequence
+
+import numpy as np
+import pandas as pd
+from pandas import Series
+
+import app.transformer as transformer
+from app.property_price_register import RawPropertySale
+from app.sales_batch import SalesBatch, Category, full_price_flag, vat_exclusive_flag, new_flag, to_cents
+from app.sanitiser import Sanitiser
+
+regexes = Sanitiser.regexes
+epoch_ordinal = datetime.date(1970, 1, 1).toordinal()
+size_descriptions = {
+    "less than 38 sq metres": "small",
+    "greater than or equal to 38 sq metres and less than 125 sq metres": "medium",
+    "greater than or equal to 125 sq metres": "large"
+}
+
+
+def clean(sales: List[RawPropertySale], sanitise: bool) -> SalesBatch:
+    """Applies the Sanitiser and transformer rules a column at a time rather than a sale at a time.
+
+    Each column is factorized into its distinct values and a code for every sale, so the rules run once for each
+    distinct value, a few dozen postcodes or a few thousand prices, and numpy takes the results back out to the sales.
+    The address, whose rules are too irregular to vectorise, is transformed once for each distinct address, postcode
+    and county rather than once for every sale. The sales themselves are left unchanged.
+    """
+    if len(sales) == 0:
+        return SalesBatch()
+    columns = {field: DistinctColumn(list(map(attrgetter(field), sales))) for field in RawPropertySale.__slots__[1:]}
+    if sanitise:
+        sanitise_columns(columns)
+        logging.debug("Sanitised '{}' raw property sales".format(len(sales)))
+    batch = transform_columns(list(map(attrgetter('app_id'), sales)), columns)
+    logging.debug("Transformed '{}' property sales".format(len(batch)))
+    return batch
+
+
+class DistinctColumn:
+    """A column held as its distinct values, in order of first appearance, and the code of each row's value"""
+    __slots__ = ('codes', 'values')
+
+    def __init__(self, column: Sequence[str]):
+        codes, uniques = pd.factorize(np.array(column, dtype=object), sort=False)
+        self.codes: np.ndarray = codes
+        self.values: Series = Series(uniques, dtype=object)
+
+    def counts(self) -> np.ndarray:
+        return np.bincount(self.codes, minlength=len(self.values))
+
+    def take(self, transformed) -> np.ndarray:
+        """The value of every row from the transformed distinct values"""
+        return np.asarray(transformed)[self.codes]
+
+
+def sanitise_columns(columns: Dict[str, DistinctColumn]):
+    columns['postcode'].values = __sanitise_postcode(columns['postcode'])
+    price = columns['price'].values
+    __warn_unusual('price', columns['price'], ~price.str.match(regexes['price'].pattern))
+    columns['property_description'].values = __sanitise_property_description(columns['property_description'])
+    columns['size_description'].values = __sanitise_size_description(columns['size_description'])
+
+
+def __sanitise_postcode(column: DistinctColumn) -> Series:
+    postcode = column.values
+    dublin = postcode.str.match(regexes['postcode']['dublin']['gaeilge'].pattern)
+    none = ~dublin & postcode.str.match(regexes['postcode']['none']['gaeilge'].pattern)
+    __warn_unusual('postcode', column, ~dublin & ~none & (postcode.str.len() > 0) &
+                   ~postcode.str.match(regexes['postcode']['dublin']['bearla'].pattern))
+    return __replace_where(__replace_where(postcode, dublin, regexes['postcode']['dublin']['gaeilge'], 'Dublin'),
+                           none, regexes['postcode']['none']['gaeilge'], '')
+
+
+def __sanitise_property_description(column: DistinctColumn) -> Series:
+    description = column.values
+    new = description.str.match(regexes['description']['new']['gaeilge'].pattern)
+    used = ~new & description.str.match(regexes['description']['used']['gaeilge'].pattern)
+    __warn_unusual('property description', column, ~new & ~used &
+                   ~description.str.match(regexes['description']['new']['bearla'].pattern) &
+                   ~description.str.match(regexes['description']['used']['bearla'].pattern))
+    description = __replace_where(description, new, regexes['description']['new']['gaeilge'],
+                                  'New Dwelling house /Apartment')
+    return __replace_where(description, used, regexes['description']['used']['gaeilge'],
+                           'Second-Hand Dwelling house /Apartment')
+
+
+def __sanitise_size_description(column: DistinctColumn) -> Series:
+    size = column.values
+    large = size.str.match(regexes['size']['large']['bearla'].pattern)
+    medium = ~large & size.str.match(regexes['size']['medium']['gaeilge'].pattern)
+    small = ~large & ~medium & size.str.match(regexes['size']['small']['gaeilge'].pattern)
+    __warn_unusual('size description', column, ~large & ~medium & ~small & (size.str.len() > 0) &
+                   ~size.str.match(regexes['size']['medium']['bearla'].pattern) &
+                   ~size.str.match(regexes['size']['small']['bearla'].pattern))
+    size = __replace_where(size, large, regexes['size']['large']['bearla'], 'greater than or equal to 125 sq metres')
+    size = __replace_where(size, medium, regexes['size']['medium']['gaeilge'],
+                           'greater than or equal to 38 sq metres and less than 125 sq metres')
+    return __replace_where(size, small, regexes['size']['small']['gaeilge'], 'less than 38 sq metres')
+
+
+def __replace_where(column: Series, mask: Series, regex, replacement: str) -> Series:
+    if not mask.any():
+        return column
+    column = column.copy()
+    column[mask] = column[mask].str.replace(regex, replacement, regex=True)
+    return column
+
+
+def __warn_unusual(name: str, column: DistinctColumn, mask: Series):
+    # each distinct value is recorded once with the number of sales it appears on
+    for value, count in zip(column.values[mask], column.counts()[mask.values]):
+        Sanitiser.record_anomaly(name, value, int(count))
+
+
+def transform_columns(app_ids: Sequence[str], columns: Dict[str, DistinctColumn]) -> SalesBatch:
+    batch = SalesBatch()
+    batch.app_ids = list(app_ids)
+    dates = pd.to_datetime(columns['date'].values, format="%d/%m/%Y").values.astype('datetime64[D]').astype(np.int64)
+    batch.dates.frombytes(columns['date'].take(dates + epoch_ordinal).astype(np.int32).tobytes())
+    batch.addresses = __transform_addresses(columns['address'], columns['postcode'], columns['county'])
+    batch.prices.frombytes(columns['price'].take(__transform_price(columns['price'].values)).astype(np.int64)
+                           .tobytes())
+    flags = columns['not_full_price'].take(np.where(columns['not_full_price'].values == "No", full_price_flag, 0)) | \
+        columns['vat_exclusive'].take(np.where(columns['vat_exclusive'].values == "Yes", vat_exclusive_flag, 0)) | \
+        columns['property_description'].take(np.where(
+            columns['property_description'].values == "New Dwelling house /Apartment", new_flag, 0))
+    batch.flags.frombytes(flags.astype(np.uint8).tobytes())
+    sizes_transformed = columns['size_description'].values.map(size_descriptions).fillna("")
+    for codes, category, column, transformed in [
+            (batch.postcodes, batch.postcode_category, columns['postcode'], columns['postcode'].values),
+            (batch.counties, batch.county_category, columns['county'], columns['county'].values),
+            (batch.sizes, batch.size_category, columns['size_description'], sizes_transformed)]:
+        __encode(codes, category, column, transformed)
+    return batch
+
+
+def __transform_addresses(address: DistinctColumn, postcode: DistinctColumn, county: DistinctColumn) -> List[str]:
+    # the codes of the three columns are combined into one, so each distinct combination is transformed only once
+    combined = (address.codes.astype(np.int64) * len(postcode.values) + postcode.codes) * len(county.values) + \
+        county.codes
+    codes, uniques = pd.factorize(combined, sort=False)
+    uniques = np.asarray(uniques)
+    county_codes = uniques % len(county.values)
+    postcode_codes = uniques // len(county.values) % len(postcode.values)
+    address_codes = uniques // len(county.values) // len(postcode.values)
+    transformed = np.empty(len(uniques), dtype=object)
+    transformed[:] = [transformer.transform_address(*values) for values in zip(
+        address.values.values[address_codes], postcode.values.values[postcode_codes],
+        county.values.values[county_codes])]
+    return transformed[codes].tolist()
+
+
+def __transform_price(price: Series) -> np.ndarray:
+    clean_price = price.str.replace('€', '', regex=False).str.replace(',', '', regex=False)
+    # euros with two decimal places are parsed exactly as doubles well short of 2 ** 53 cents
+    valid = (clean_price.str.fullmatch(r'[0-9]+\.[0-9]{2}') & (clean_price.str.len() <= 15)).values
+    cents = np.zeros(len(price), dtype=np.int64)
+    cents[valid] = np.rint(pd.to_numeric(clean_price[valid]).values * 100).astype(np.int64)
+    for position in np.flatnonzero(~valid):  # anything unusual goes through the per sale rules
+        cents[position] = to_cents(transformer.transform_price(price.iat[position]))
+    return cents
+
+
+def __encode(codes, category: Category, column: DistinctColumn, transformed: Series):
+    # the transformed values are factorized again, as distinct raw values can transform to the same one
+    factorized, uniques = pd.factorize(transformed.astype(object), sort=False)
+    encoded = np.array([category.encode(value) for value in uniques], dtype=np.uint16)
+    codes.frombytes(encoded[factorized][column.codes].tobytes())
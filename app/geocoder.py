@@ -1,7 +1,8 @@
 import json
 import logging
+from concurrent.futures import ThreadPoolExecutor, Future, CancelledError, wait, FIRST_COMPLETED
 from datetime import datetime
-from typing import List
+from typing import Iterable, List, Dict, Tuple
 
 import geopy
 import pymongo
@@ -9,88 +10,370 @@ import pymongo
 from bson import json_util
 from geopy import Location
 from geopy.exc import GeocoderTimedOut, GeocoderQuotaExceeded
-from pymongo import InsertOne, UpdateOne
+from pymongo import UpdateOne, UpdateMany
+from pymongo.errors import DuplicateKeyError
 
-from app import config
+from app import config, metrics
 from app.geocoding.provider import Provider
+from app.transformer import canonical_address_key
+from app.util import iteration
+from app.util.throttle import TokenBucket
 
 logging.getLogger('geopy').setLevel(logging.WARN)
 
-client = pymongo.MongoClient(config['mongo']['connection'])
-database = client.get_database(config['geocoding']['database'])
-collection = database.get_collection(config['geocoding']['store'])
-collection.create_index("address")
+client = None
+collection = None
+processed_indexes = set()
 
 geopy.geocoders.options.default_timeout = config['geocoding']['timeout']
 
 
-def update_addresses(addresses: List[str]):
+def get_collection():
+    # connected on first use so that runs without the geocode stage never touch MongoDB
+    global client, collection
+    if collection is None:
+        client = pymongo.MongoClient(config['mongo']['connection'])
+        collection = client.get_database(config['geocoding']['database']).get_collection(config['geocoding']['store'])
+        __create_address_index(collection)
+        __create_key_index(collection)
+    return collection
+
+
+def __create_address_index(collection):
+    index = collection.index_information().get("address_1")
+    if index is not None and index.get('unique', False):
+        return
+    # collections from before addresses were unique hold an address once for every sale of it
+    __merge_duplicate_addresses(collection)
+    if index is not None:
+        logging.info("Replacing the non-unique address index of '{}'".format(collection.name))
+        collection.drop_index("address_1")
+    try:
+        collection.create_index("address", unique=True)
+    except DuplicateKeyError:
+        logging.error("Collection '{}' has duplicate addresses so they can't be indexed as unique".format(
+            collection.name))
+        if index is not None:
+            collection.create_index("address")  # left as it was found
+        raise
+
+
+def __merge_duplicate_addresses(collection):
+    """Keeps one document for each address, holding what was geocoded for any of its duplicates."""
+    duplicates = collection.aggregate([
+        {"$group": {"_id": "$address", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True)
+    merged = 0
+    for duplicate in duplicates:
+        documents = list(collection.find({"_id": {"$in": duplicate['ids']}}, {"geocoded": 1}).sort("_id"))
+        geocoded = __merge_geocoded(document.get('geocoded', {}) for document in documents)
+        collection.update_one({"_id": documents[0]['_id']}, {"$set": {"geocoded": geocoded}})
+        merged += collection.delete_many({"_id": {"$in": [document['_id'] for document in documents[1:]]}}) \
+            .deleted_count
+    if merged != 0:
+        logging.info("Merged '{}' duplicate addresses of collection '{}'".format(merged, collection.name))
+
+
+def __merge_geocoded(geocodings: Iterable[Dict]) -> Dict:
+    # the first result or processed time of each provider is kept, a provider any of them processed stays processed
+    merged = {}
+    for geocoded in geocodings:
+        for field, value in geocoded.items():
+            if merged.get(field) is None:
+                merged[field] = value
+    return merged
+
+
+def __create_key_index(collection):
+    """Indexes the canonical key of every address, keying those registered before addresses had one."""
+    collection.create_index("key")
+    # addresses without a key are indexed as null so there is nothing to scan once they're all keyed
+    unkeyed = collection.find({"key": None}, {"address": 1, "_id": 0},
+                              batch_size=config['geocoding']['cursor-batch-size'])
+    keyed = 0
+    for batch in iteration.batches(unkeyed, config['geocoding']['register-batch-size']):
+        keyed += collection.bulk_write([UpdateOne({"address": document['address']},
+                                                  {"$set": {"key": canonical_address_key(document['address'])}})
+                                        for document in batch], ordered=False).modified_count
+    if keyed != 0:
+        logging.info("Keyed '{}' addresses of collection '{}'".format(keyed, collection.name))
+
+
+def __unprocessed_filter(processed_key: str) -> Dict:
+    """Matches the addresses a provider hasn't processed, through an index on its processed time.
+
+    Missing times are indexed as null, so the addresses still to do are found by an index seek rather than a scan of
+    the collection, however many have already been processed.
+    """
+    field = "geocoded." + processed_key
+    if field not in processed_indexes:
+        get_collection().create_index([(field, pymongo.ASCENDING), ("address", pymongo.ASCENDING)])
+        processed_indexes.add(field)
+    return {field: None}
+
+
+def update_addresses(addresses: Iterable[str]) -> int:
+    """Registers any addresses not already in the collection and returns how many were new.
+
+    Each batch is first looked up through the unique address index, reading nothing but the address. Only the
+    missing ones are upserted, unordered, so the cost follows the number of new addresses rather than the size of the
+    collection. A new address starts with everything geocoded for the others with the same canonical key.
+    """
+    collection = get_collection()
     logging.debug("Updating address collection '{}'".format(collection.name))
-    existing_addresses = set(cursor['address'] for cursor in collection.find())
-    different_addresses = [x for x in addresses if x not in existing_addresses]
-    logging.debug("Inserting '{}' new addresses into '{}'".format(len(different_addresses), collection.name))
-    operations = [InsertOne({"address": address, 'geocoded': {}}) for address in different_addresses]
-    if len(operations) > 0:
-        collection.bulk_write(operations)
-        logging.info("Inserted addresses into collection '{}'".format(collection.name))
+    inserted = 0
+    for batch in iteration.batches(addresses, config['geocoding']['register-batch-size']):
+        batch = list(dict.fromkeys(batch))  # resales repeat an address
+        existing = set(document['address'] for document in
+                       collection.find({"address": {"$in": batch}}, {"address": 1, "_id": 0}))
+        keys = {address: canonical_address_key(address) for address in batch if address not in existing}
+        variants = {}
+        for document in collection.find({"key": {"$in": list(set(keys.values()))}},
+                                        {"key": 1, "geocoded": 1, "_id": 0}):
+            variants.setdefault(document['key'], []).append(document.get('geocoded', {}))
+        # the variants of a key geocoded before there were keys may each have been processed by different providers
+        geocoded = {key: __merge_geocoded(sorted(geocodings, key=len, reverse=True))
+                    for key, geocodings in variants.items()}
+        operations = [UpdateOne({"address": address},
+                                {"$setOnInsert": {"address": address, "key": key, 'geocoded': geocoded.get(key, {})}},
+                                upsert=True)
+                      for address, key in keys.items()]
+        if len(operations) > 0:
+            # an address registered by another run in the meantime is matched rather than duplicated
+            inserted += collection.bulk_write(operations, ordered=False).upserted_count
+    logging.info("Inserted '{}' new addresses into collection '{}'".format(inserted, collection.name))
+    return inserted
+
+
+def __process_location(location: Location, document: Dict, provider: Provider, processed_key: str, time: datetime):
+    return __update_variants(document, __location_fields(location, provider, processed_key, time))
+
+
+def __update_variants(document: Dict, fields: Dict):
+    # the result for one address is stored for every address with the same canonical key
+    if document.get('key') is None:
+        return UpdateOne({"address": document['address']}, {"$set": fields})
+    return UpdateMany({"key": document['key']}, {"$set": fields})
 
 
-def __process_location(location: Location, address: str, provider: Provider, processed_key: str, time: datetime) -> UpdateOne:
+def __request_key(document: Dict) -> str:
+    return document['key'] if document.get('key') is not None else document['address']
+
+
+def __location_fields(location: Location, provider: Provider, processed_key: str, time: datetime) -> Dict:
     if location is not None:
         data = {key: location.raw.get(key, None) for key in provider.raw_location_keys()}
-        return UpdateOne({"address": address},
-                     {"$set": {"geocoded." + provider.identifier():
-                         {
-                             "address": location.address,
-                             "altitude": location.altitude,
-                             "latitude": location.latitude,
-                             "longitude": location.longitude,
-                             "raw": data
-                         },
-                         "geocoded." + processed_key: time
-                     }
-                     })
+        return {"geocoded." + provider.identifier():
+                {
+                    "address": location.address,
+                    "altitude": location.altitude,
+                    "latitude": location.latitude,
+                    "longitude": location.longitude,
+                    "raw": data
+                },
+                "geocoded." + processed_key: time
+                }
     else:
-        return UpdateOne({"address": address}, {"$set": {"geocoded." + processed_key: time}})
+        return {"geocoded." + processed_key: time}
 
 
 def __bulk_write(operations, provider_identifier):
+    collection = get_collection()
     logging.debug("Writing '{}' from '{}' geocodings to '{}'".format(len(operations), provider_identifier, collection.name))
     collection.bulk_write(operations)
 
 
-def geocode(provider: Provider):
+def geocode(provider: Provider) -> int:
+    """Geocodes the addresses the provider hasn't processed yet, several at a time, and returns how many it geocoded.
+
+    At most the provider's concurrency are requested at once, no faster than its requests per second. No more are
+    requested than could take the count over its maximum and none once its quota is exceeded. Only one address is
+    requested for each canonical key, its result stored for all of them.
+    """
     processed_key = provider.identifier() + config['geocoding']['processed-suffix']
     flush_count = config['geocoding']['flush-count']
-    unprocessed_addresses = collection.find({"geocoded." + processed_key: None})
+    provider_config = config['geocoders'][provider.identifier()]
+    concurrency = provider_config['concurrency']
+    bucket = TokenBucket(provider_config['requests-per-second']) \
+        if provider_config['requests-per-second'] != -1 else None
+    max_requests = provider.max_requests()
+    unprocessed = __unprocessed_filter(processed_key)
+    unprocessed_addresses = get_collection().find(unprocessed, {"address": 1, "key": 1, "_id": 0},
+                                                  batch_size=config['geocoding']['cursor-batch-size'])
     operations = list()
     count = 0
     time = datetime.now()
-    logging.info("'{}' addresses to geocode with '{}'".format(unprocessed_addresses.count(), provider.identifier()))
-    for unprocessed_address in unprocessed_addresses:
-        address = unprocessed_address['address']
-        try:
-            location: Location = provider.geocode(address)
-            operations.append(__process_location(location, address, provider, processed_key, time))
-            count += 1
-        except GeocoderTimedOut:
-            logging.warning("Geocoder timed out on address '{}'".format(address))
-        except GeocoderQuotaExceeded:
-            logging.warning("Geocoder quota exceeded with '{}'".format(provider.identifier()))
-            break
-        if count % flush_count == 0 and count != 0 and len(operations) != 0:
-            __bulk_write(operations, provider.identifier())
-            operations.clear()
-        if count >= provider.max_requests() != -1:
-            break
+    logging.info("'{}' addresses to geocode with '{}'".format(get_collection().count_documents(unprocessed),
+                                                                provider.identifier()))
+    documents = iter(unprocessed_addresses)
+    requested = set()
+    pending = {}
+    quota_exceeded = False
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            while not quota_exceeded and len(pending) < concurrency and \
+                    (max_requests == -1 or count + len(pending) < max_requests):
+                document = next(documents, None)
+                if document is None:
+                    break
+                if __request_key(document) in requested:
+                    continue  # another spelling of an address already requested
+                requested.add(__request_key(document))
+                pending[executor.submit(__geocode_address, provider, document['address'], bucket)] = document
+            if len(pending) == 0:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                document = pending.pop(future)
+                try:
+                    location: Location = future.result()
+                    operations.append(__process_location(location, document, provider, processed_key, time))
+                    count += 1
+                except GeocoderTimedOut:
+                    logging.warning("Geocoder timed out on address '{}'".format(document['address']))
+                except GeocoderQuotaExceeded:
+                    if not quota_exceeded:
+                        logging.warning("Geocoder quota exceeded with '{}'".format(provider.identifier()))
+                    quota_exceeded = True  # those already requested are still stored
+                if count % flush_count == 0 and count != 0 and len(operations) != 0:
+                    __bulk_write(operations, provider.identifier())
+                    operations.clear()
     if len(operations) != 0:
         __bulk_write(operations, provider.identifier())
+    return count
+
+
+def __geocode_address(provider: Provider, address: str, bucket: TokenBucket) -> Location:
+    if bucket is not None:
+        bucket.acquire()
+    return provider.geocode(address)
+
+
+class ProviderQueue:
+    """A provider's share of a fan-out: its workers, rate limit and backlog of requests, and what it has done"""
+
+    def __init__(self, provider: Provider, backlog: int):
+        self.provider = provider
+        self.processed_key = provider.identifier() + config['geocoding']['processed-suffix']
+        provider_config = config['geocoders'][provider.identifier()]
+        self.executor = ThreadPoolExecutor(max_workers=provider_config['concurrency'])
+        self.bucket = TokenBucket(provider_config['requests-per-second']) \
+            if provider_config['requests-per-second'] != -1 else None
+        self.backlog = max(backlog, provider_config['concurrency'])
+        self.max_requests = provider.max_requests()
+        self.requested = set()
+        self.pending = 0
+        self.count = 0
+        self.quota_exceeded = False
+
+    def wants(self, key: str, document: Dict) -> bool:
+        return not self.exhausted() and key not in self.requested and \
+            document.get('geocoded', {}).get(self.processed_key) is None
+
+    def exhausted(self) -> bool:
+        return self.quota_exceeded or (self.max_requests != -1 and self.count >= self.max_requests)
+
+    def accepting(self) -> bool:
+        return self.pending < self.backlog and (self.max_requests == -1 or
+                                                self.count + self.pending < self.max_requests)
+
+
+def geocode_all(providers: List[Provider]) -> Dict[str, int]:
+    """Geocodes with every provider in a single walk of the addresses and returns how many each geocoded.
+
+    Each address is handed to every provider that hasn't processed it, each with its own concurrency, requests per
+    second, maximum requests and quota, just as when geocoding with one provider. A provider holds a backlog of up to
+    fan-out backlog addresses, so a slow or throttled provider lets the walk run ahead of it. When its backlog is full
+    it is passed over for the addresses the others have room for, which it is given on the next run, and the walk only
+    waits when none of the providers that want the next address have room for it. Once every provider given an
+    address has answered, their results are stored with a single update for every address with its canonical key.
+    """
+    queues = [ProviderQueue(provider, config['geocoding']['fan-out']['backlog']) for provider in providers]
+    flush_count = config['geocoding']['flush-count']
+    projection = {"address": 1, "key": 1, "_id": 0}
+    projection.update({"geocoded." + queue.processed_key: 1 for queue in queues})
+    unprocessed = {"$or": [__unprocessed_filter(queue.processed_key) for queue in queues]}
+    logging.info("'{}' addresses to geocode with '{}'".format(get_collection().count_documents(unprocessed),
+                                                                [queue.provider.identifier() for queue in queues]))
+    documents = iter(get_collection().find(unprocessed, projection,
+                                           batch_size=config['geocoding']['cursor-batch-size']))
+    document = None
+    in_flight: Dict[Future, Tuple[str, ProviderQueue]] = {}
+    outstanding: Dict[str, List] = {}  # a document of each key, its merged fields and how many providers are to answer
+    operations = list()
+    time = datetime.now()
+    try:
+        while True:
+            while not all(queue.exhausted() for queue in queues):
+                if document is None:
+                    document = next(documents, None)
+                    if document is None:
+                        break
+                key = __request_key(document)
+                wanting = [queue for queue in queues if queue.wants(key, document)]
+                accepting = [queue for queue in wanting if queue.accepting()]
+                if len(wanting) != 0 and len(accepting) == 0:
+                    break  # waits for a provider that wants it to have room
+                for queue in wanting:
+                    # those passed over aren't given the key again through another spelling later in the walk
+                    queue.requested.add(key)
+                for queue in accepting:
+                    queue.pending += 1
+                    future = queue.executor.submit(__geocode_address, queue.provider, document['address'], queue.bucket)
+                    in_flight[future] = (key, queue)
+                if len(accepting) != 0:
+                    # a spelling one provider has already processed may be given to the others while another spelling
+                    # of it is still out with that provider
+                    outstanding.setdefault(key, [document, {}, 0])[2] += len(accepting)
+                document = None
+            if len(in_flight) == 0:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                key, queue = in_flight.pop(future)
+                queue.pending -= 1
+                answers = outstanding[key]
+                answers[2] -= 1
+                try:
+                    location: Location = future.result()
+                    answers[1].update(__location_fields(location, queue.provider, queue.processed_key, time))
+                    queue.count += 1
+                except CancelledError:
+                    pass
+                except GeocoderTimedOut:
+                    logging.warning("Geocoder '{}' timed out on address '{}'".format(queue.provider.identifier(),
+                                                                                   answers[0]['address']))
+                except GeocoderQuotaExceeded:
+                    if not queue.quota_exceeded:
+                        logging.warning("Geocoder quota exceeded with '{}'".format(queue.provider.identifier()))
+                        # those already requested are still stored, the rest of its backlog is dropped
+                        for backlogged, (_, backlogged_queue) in in_flight.items():
+                            if backlogged_queue is queue:
+                                backlogged.cancel()
+                    queue.quota_exceeded = True
+                if answers[2] == 0:
+                    del outstanding[key]
+                    if len(answers[1]) != 0:
+                        operations.append(__update_variants(answers[0], answers[1]))
+            if len(operations) >= flush_count:
+                __bulk_write(operations, "all providers")
+                operations.clear()
+    finally:
+        for future in in_flight:
+            future.cancel()
+        for queue in queues:
+            queue.executor.shutdown()
+    if len(operations) != 0:
+        __bulk_write(operations, "all providers")
+    return {queue.provider.identifier(): queue.count for queue in queues}
 
 
 def export_collection(output_file):
     try:
         with open(output_file, 'w', encoding='utf-8') as file:
-            json.dump(list(collection.find()), file, default=json_util.default, ensure_ascii=False, indent=4)
+            json.dump(list(get_collection().find()), file, default=json_util.default, ensure_ascii=False, indent=4)
+        metrics.record_file(output_file)
         logging.info("Exported transformed sales to '{}'".format(output_file))
     except IOError:
         logging.error("Unable to process file '{}'".format(output_file))
@@ -0,0 +1,32 @@
+import importlib
+from typing import Iterator
+
+from app import config
+from app.geocoding.provider import Provider
+
+# providers are only imported and instantiated when enabled, as some need API keys and all of them import geopy
+providers = [
+    {'config_key': 'nominatim', 'implementation': 'app.geocoding.nominatim.Nominatim'},
+    {'config_key': 'bing', 'implementation': 'app.geocoding.bing.Bing'},
+    {'config_key': 'arcgis', 'implementation': 'app.geocoding.arcgis.ArcGIS'},
+    {'config_key': 'here', 'implementation': 'app.geocoding.here.Here'},
+    {'config_key': 'photon', 'implementation': 'app.geocoding.photon.Photon'},
+    {'config_key': 'azure', 'implementation': 'app.geocoding.azure.Azure'},
+    {'config_key': 'mapbox', 'implementation': 'app.geocoding.mapbox.MapBox'},
+    {'config_key': 'opencage', 'implementation': 'app.geocoding.opencage.OpenCage'},
+    {'config_key': 'tomtom', 'implementation': 'app.geocoding.tomtom.TomTom'},
+    {'config_key': 'google', 'implementation': 'app.geocoding.google.Google'},
+]
+
+
+def enabled_modules() -> Iterator[str]:
+    for provider in providers:
+        if config['geocoders'][provider['config_key']]['enabled']:
+            yield provider['implementation'].rsplit('.', 1)[0]
+
+
+def enabled_providers() -> Iterator[Provider]:
+    for provider in providers:
+        if config['geocoders'][provider['config_key']]['enabled']:
+            module_name, class_name = provider['implementation'].rsplit('.', 1)
+            yield getattr(importlib.import_module(module_name), class_name)()
@@ -1,76 +1,206 @@
 import json
 import logging
-from typing import List
+import os
+from pathlib import Path
+from typing import List, Iterable, Iterator
 
-import app.analyser as analysis
-import app.geocoder as geocoding
+import app.cleaner as cleaner
 import app.property_price_register as price_register
-import app.sanitiser as sanitiser
-import app.transformer as transformer
-from app import config, storage
-from app.geocoding.arcgis import ArcGIS
-from app.geocoding.azure import Azure
-from app.geocoding.bing import Bing
-from app.geocoding.google import Google
-from app.geocoding.here import Here
-from app.geocoding.mapbox import MapBox
-from app.geocoding.nominatim import Nominatim
-from app.geocoding.opencage import OpenCage
-from app.geocoding.photon import Photon
-from app.geocoding.tomtom import TomTom
+from app import config, metrics
+from app.util import iteration
 from app.property_price_register import RawPropertySale
+from app.sales_batch import SalesBatch
 from app.transformer import TransformedPropertySale
 
+if config['storage']['backend'] == 'parquet':
+    import app.parquet_storage as storage
+else:
+    import app.storage as storage
 
-def get_raw_sales() -> List[RawPropertySale]:
+
+def __download_register():
     if config['register']['download']['enabled']:
-        price_register.download_csv()
-        logging.info("Downloaded and extracted raw property sales csv file")
+        if price_register.download_csv():
+            logging.info("Downloaded and extracted raw property sales csv file")
+        else:
+            logging.info("Raw property sales csv file is unchanged since the last download")
+
+
+def get_raw_sales() -> List[RawPropertySale]:
+    __download_register()
     raw_sales = price_register.parse_csv()
     logging.info("'{}' raw property sales prices received".format(len(raw_sales)))
+    metrics.record_rows(rows_in=len(raw_sales), rows_out=len(raw_sales))
     if config['register']['persist']['enabled']:
-        storage.persist_raw_sales(raw_sales)
-        logging.info("Persisted raw property sales")
+        stored_sales = storage.persist_raw_sales(raw_sales)
+        logging.info("Persisted '{}' new raw property sales".format(len(stored_sales)))
     return raw_sales
 
 
-def clean_sales(sales=None) -> List[TransformedPropertySale]:
-    if sales is None:
+def clean_sales(sales=None) -> SalesBatch:
+    if sales is None and config['storage']['ingest']['mode'] == 'append':
+        sales = storage.read_untransformed_raw_sales()
+    elif sales is None:
         sales = storage.read_raw_sales()
     logging.info("Received '{}' raw sales".format(len(sales)))
-    # it could be nice to deep copy of raw property sales but didn't for efficiency and memory concerns
-    if config['data_clean']['sanitiser']['enabled']:
-        sales = [sanitiser.Sanitiser(sale).sanitise() for sale in sales]
-        logging.info("Sanitised raw property sales")
-    logging.info("Transforming property sales")
-    sales = [transformer.transformed_from_raw(sale) for sale in sales]
-    logging.info("Transformed property sales")
+    metrics.record_rows(rows_in=len(sales))
+    sales = cleaner.clean(sales)
+    cleaner.log_anomalies()
+    metrics.record_rows(rows_out=len(sales))
     if config['data_clean']['persist']['enabled']:
         storage.persist_transformed_sales(sales)
         logging.info("Persisted transformed sales")
+    if config['analysis']['sketches']['enabled']:
+        # the sales read are only new to the transformed table if the cleaned ones are stored there
+        store = __sketch_store(new_sales_only=config['data_clean']['persist']['enabled'])
+        if store is not None:
+            store.fold(sales)
+            __sketches().save(store)
     if config['data_clean']['output']['enabled']:
-        output_file = config['data_clean']['output']['path'] + "sales.json"
-        try:
-            with open(output_file, 'w', encoding='utf-8') as file:
-                json.dump([sale.json_serialise() for sale in sales], file, ensure_ascii=False, indent=4)
-            logging.info("Exported transformed sales to '{}'".format(output_file))
-        except IOError:
-            logging.error("Unable to process file '{}'".format(output_file))
-            raise ValueError("There was an issue writing to the file '{}'".format(output_file))
+        __export_sales([sales], new_sales_only=config['data_clean']['persist']['enabled'])
     return sales
 
 
+def __sketches():
+    # numpy is only imported once a stage folds or reads the sketches
+    import app.sketches as sketches
+    return sketches
+
+
+def __sketch_store(new_sales_only: bool):
+    # only sales new to storage are cleaned in append mode, otherwise every sale is and the sketches start again
+    if config['storage']['ingest']['mode'] == 'append':
+        if not new_sales_only:
+            # the same sales would be cleaned, and folded into the sketches, again on every run
+            logging.warning("Sketches are only updated in append mode when the new sales are persisted")
+            return None
+        return __sketches().load()
+    return __sketches().SketchStore(config['analysis']['sketches']['relative-accuracy'])
+
+
+def __export_sales(batches: Iterable[SalesBatch], new_sales_only: bool) -> int:
+    output_file = config['data_clean']['output']['path'] + "sales.json"
+    # only the sales new to storage are cleaned in append mode so they are added to those already exported, unless
+    # the same sales are cleaned every run as none are persisted
+    append = config['storage']['ingest']['mode'] == 'append' and new_sales_only and Path(output_file).exists()
+    count = 0
+    try:
+        with open(output_file, 'r+b' if append else 'wb') as file:
+            # written one sale at a time, matching the layout of json.dump with an indent of 4
+            if append:
+                exported = __reopen_export(file, output_file)
+            else:
+                file.write(b"[")
+                exported = False
+            for batch in batches:
+                for row in batch:
+                    serialised = json.dumps(TransformedPropertySale(*row).json_serialise(), ensure_ascii=False,
+                                            indent=4)
+                    file.write((("," if exported or count != 0 else "") + "\n    " +
+                                serialised.replace("\n", "\n    ")).encode('utf-8'))
+                    count += 1
+            file.write(b"\n]" if exported or count != 0 else b"]")
+        metrics.record_file(output_file)
+        logging.info("Exported transformed sales to '{}'".format(output_file))
+    except IOError:
+        logging.error("Unable to process file '{}'".format(output_file))
+        raise ValueError("There was an issue writing to the file '{}'".format(output_file))
+    return count
+
+
+def __reopen_export(file, output_file: str) -> bool:
+    """Truncates the closing bracket of the exported sales, returning whether any sales were already exported"""
+    file.seek(0, os.SEEK_END)
+    end = file.tell()
+    file.seek(max(0, end - 16))
+    tail = file.read()
+    body = tail.rstrip()
+    if not body.endswith(b"]"):
+        logging.error("Exported sales in '{}' are incomplete".format(output_file))
+        raise ValueError("There was an issue appending to the file '{}'".format(output_file))
+    body = body[:-1].rstrip()
+    file.seek(end - len(tail) + len(body))
+    file.truncate()
+    return not body.endswith(b"[")
+
+
+def stream_sales():
+    __download_register()
+    if config['register']['persist']['enabled']:
+        storage.prepare_raw_sales_table()
+    if config['pipeline']['enabled']['clean-data'] and config['data_clean']['persist']['enabled']:
+        storage.prepare_transformed_sales_table()
+    __run_stream(price_register.parse_csv_batches(config['pipeline']['streaming']['batch-size']),
+                 persist_raw=config['register']['persist']['enabled'],
+                 new_sales_only=config['register']['persist']['enabled'])
+
+
+def stream_clean_sales():
+    if config['storage']['ingest']['mode'] == 'append':
+        raw_sales = storage.stream_untransformed_raw_sales()
+    else:
+        raw_sales = storage.stream_raw_sales()
+    if config['data_clean']['persist']['enabled']:
+        storage.prepare_transformed_sales_table()
+    __run_stream(iteration.batches(raw_sales, config['pipeline']['streaming']['batch-size']), persist_raw=False,
+                 new_sales_only=config['data_clean']['persist']['enabled'])
+
+
+def __run_stream(raw_batches: Iterator[List[RawPropertySale]], persist_raw: bool, new_sales_only: bool):
+    store = None
+    if config['pipeline']['enabled']['clean-data'] and config['analysis']['sketches']['enabled']:
+        store = __sketch_store(new_sales_only)
+    batches = __stream_batches(raw_batches, persist_raw, store)
+    if config['pipeline']['enabled']['clean-data'] and config['data_clean']['output']['enabled']:
+        count = __export_sales(batches, new_sales_only)
+    else:
+        count = sum(len(batch) for batch in batches)
+    if store is not None:
+        __sketches().save(store)
+    cleaner.log_anomalies()
+    metrics.record_rows(rows_out=count)
+    logging.info("Streamed '{}' property sales through the pipeline".format(count))
+
+
+def __stream_batches(raw_batches: Iterator[List[RawPropertySale]], persist_raw: bool, store=None) -> Iterator:
+    rows_in = 0
+    for batch in raw_batches:
+        logging.debug("Received batch of '{}' raw property sales".format(len(batch)))
+        rows_in += len(batch)
+        metrics.record_rows(rows_in=rows_in)
+        if persist_raw:
+            # before sanitising as the sanitiser updates the sales in place, only new sales go on to be cleaned
+            batch = storage.append_raw_sales(batch)
+        if config['pipeline']['enabled']['clean-data']:
+            batch = cleaner.clean(batch)
+            if config['data_clean']['persist']['enabled']:
+                storage.append_transformed_sales(batch)
+            if store is not None:
+                store.fold(batch)
+        yield batch
+
+
+def __analysis():
+    # pandas and plotly are most of the startup time so they are only imported once the analyse stage runs
+    import app.analyser as analysis
+    return analysis
+
+
 def analyse_data(sales=None):
     if sales is None:
-        sales = storage.read_transformed_sales()
+        sales = storage.read_transformed_sales_batch()
     logging.info("Received '{}' transformed sales".format(len(sales)))
-    analyser = analysis.Analyser(sales)
+    metrics.record_rows(rows_in=len(sales))
+    analyser = __analysis().Analyser(sales)
+    # the frame holds everything the analysis needs, so the sales are released for the rest of the stage
+    del sales
     if config['analysis']['totals']['enabled']:
         analyser.log_totals()
     if config['analysis']['output']['transformed']['enabled']:
         analysis_data_file = config['analysis']['output']['transformed']['path'] + "analysis_data.csv"
         logging.info("Writing transformed data for analysis to '{}'".format(analysis_data_file))
         analyser.data_frame.to_csv(analysis_data_file)
+        metrics.record_file(analysis_data_file)
     descriptives = analyser.get_descriptives()
     if config['analysis']['output']['descriptives']['enabled']:
         descriptives_output_path = config['analysis']['output']['descriptives']['path']
@@ -78,6 +208,9 @@ def analyse_data(sales=None):
             "Writing descriptive statistics for various data aggregations to '{}'".format(descriptives_output_path))
         for descriptive in descriptives:
             descriptive['data'].to_csv(descriptives_output_path + descriptive['name'] + ".csv")
+            metrics.record_file(descriptives_output_path + descriptive['name'] + ".csv")
+    if config['analysis']['sketches']['enabled']:
+        __analyse_sketches()
     analyser.time_analysis()
     analyser.new_old_analysis()
     if config['analysis']['plots']['output']['enabled']:
@@ -91,38 +224,68 @@ def analyse_data(sales=None):
         analyser.upload_plots_to_chart_studio()
 
 
-geocoders = [
-    {'config_key': 'nominatim', 'implementation': Nominatim()},
-    {'config_key': 'bing', 'implementation': Bing()},
-    {'config_key': 'arcgis', 'implementation': ArcGIS()},
-    {'config_key': 'here', 'implementation': Here()},
-    {'config_key': 'photon', 'implementation': Photon()},
-    {'config_key': 'azure', 'implementation': Azure()},
-    {'config_key': 'mapbox', 'implementation': MapBox()},
-    {'config_key': 'opencage', 'implementation': OpenCage()},
-    {'config_key': 'tomtom', 'implementation': TomTom()},
-    {'config_key': 'google', 'implementation': Google()},
-]
+def __analyse_sketches():
+    store = __sketches().load()
+    logging.info("Median price of the '{}' sketched sales is '{:.2f}' to within '{:.1%}'".format(
+        store.sales, store.quantile(0.5), store.relative_accuracy))
+    if config['analysis']['output']['descriptives']['enabled']:
+        descriptives_output_path = config['analysis']['output']['descriptives']['path']
+        for descriptive in __analysis().Analyser.get_sketch_descriptives(store):
+            descriptive['data'].to_csv(descriptives_output_path + descriptive['name'] + ".csv")
+            metrics.record_file(descriptives_output_path + descriptive['name'] + ".csv")
 
 
 def geocode(sales=None):
+    # geopy and pymongo are only imported once the geocode stage runs
+    import app.geocoder as geocoding
+    import app.geocoding as geocoding_providers
     if sales is None:
-        sales = storage.read_transformed_sales()
-    logging.info("Received '{}' sales".format(len(sales)))
-    geocoding.update_addresses([sale.address for sale in sales])
-    for geocoder in geocoders:
-        if config['geocoders'][geocoder['config_key']]['enabled']:
-            geocoding.geocode(geocoder['implementation'])
+        geocoding.update_addresses(storage.stream_transformed_addresses())
+    elif isinstance(sales, SalesBatch):
+        logging.info("Received '{}' sales".format(len(sales)))
+        geocoding.update_addresses(sales.addresses)
+    else:
+        logging.info("Received '{}' sales".format(len(sales)))
+        geocoding.update_addresses([sale.address for sale in sales])
+    if config['geocoding']['fan-out']['enabled']:
+        counts = geocoding.geocode_all(list(geocoding_providers.enabled_providers()))
+        for identifier, count in counts.items():
+            logging.info("Geocoded '{}' addresses with '{}'".format(count, identifier))
+        geocoded = sum(counts.values())
+    else:
+        geocoded = 0
+        for geocoder in geocoding_providers.enabled_providers():
+            geocoded += geocoding.geocode(geocoder)
+    metrics.record_rows(rows_out=geocoded)
     if config['geocoding']['export']['enabled']:
         output_file = config['geocoding']['export']['path'] + "geocoding.json"
         geocoding.export_collection(output_file)
 
 
-if config['pipeline']['enabled']['get-raw-data']:
-    raw_property_sales = get_raw_sales()
-if config['pipeline']['enabled']['clean-data']:
-    transformed_property_sales = clean_sales()
-if config['pipeline']['enabled']['analyse']:
-    analyse_data()
-if config['pipeline']['enabled']['geocode']:
-    geocode()
+def main():
+    # behind the __main__ guard below, process pool workers started by spawn or forkserver re-import this module
+    if config['pipeline']['streaming']['enabled'] and config['pipeline']['enabled']['get-raw-data']:
+        with metrics.stage('stream'):
+            stream_sales()
+    else:
+        if config['pipeline']['enabled']['get-raw-data']:
+            with metrics.stage('get-raw-data'):
+                raw_property_sales = get_raw_sales()
+        if config['pipeline']['enabled']['clean-data'] and config['pipeline']['streaming']['enabled']:
+            with metrics.stage('clean-data'):
+                stream_clean_sales()
+        elif config['pipeline']['enabled']['clean-data']:
+            with metrics.stage('clean-data'):
+                transformed_property_sales = clean_sales()
+    if config['pipeline']['enabled']['analyse']:
+        with metrics.stage('analyse'):
+            analyse_data()
+    if config['pipeline']['enabled']['geocode']:
+        with metrics.stage('geocode'):
+            geocode()
+    if config['metrics']['enabled']:
+        metrics.write_report()
+
+
+if __name__ == '__main__':
+    main()
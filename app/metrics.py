@@ -0,0 +1,119 @@
+import json
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import List, Dict
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+from app import config
+
+# cheap counters bumped on the hot path, attributed to whichever stage is running
+counters = Counter()
+stages: List[Dict] = []
+current_stage: Dict = None
+run_started = datetime.now()
+
+counter_names = ['db_round_trips', 'db_bytes_copied', 'bytes_written']
+
+
+def increment(name: str, amount: int = 1):
+    counters[name] += amount
+
+
+def record_rows(rows_in: int = None, rows_out: int = None):
+    if current_stage is None:
+        return
+    if rows_in is not None:
+        current_stage['rows_in'] = rows_in
+    if rows_out is not None:
+        current_stage['rows_out'] = rows_out
+
+
+def record_file(file: str):
+    try:
+        increment('bytes_written', os.path.getsize(file))
+    except OSError:
+        logging.debug("Unable to measure the size of '{}'".format(file))
+
+
+@contextmanager
+def stage(name: str):
+    global current_stage
+    current_stage = {'stage': name, 'rows_in': None, 'rows_out': None}
+    counters_before = Counter(counters)
+    start = time.perf_counter()
+    try:
+        yield current_stage
+    finally:
+        elapsed = time.perf_counter() - start
+        current_stage['duration_seconds'] = elapsed
+        rows = current_stage['rows_out'] if current_stage['rows_out'] is not None else current_stage['rows_in']
+        current_stage['rows_per_second'] = rows / elapsed if rows is not None and elapsed > 0 else None
+        current_stage['max_rss_bytes'] = max_rss(resource.RUSAGE_SELF) if resource is not None else None
+        current_stage['children_max_rss_bytes'] = max_rss(resource.RUSAGE_CHILDREN) if resource is not None else None
+        for counter_name in counter_names:
+            current_stage[counter_name] = counters[counter_name] - counters_before[counter_name]
+        stages.append(current_stage)
+        logging.info("Stage '{}' took '{:.2f}'s with '{}' rows in and '{}' rows out".format(
+            name, elapsed, current_stage['rows_in'], current_stage['rows_out']))
+        current_stage = None
+
+
+def max_rss(who: int) -> int:
+    """High-water mark in bytes of the resident set size since the process started.
+
+    For RUSAGE_CHILDREN it is that of the largest finished child, e.g. a cleaning worker, not their total. Neither is
+    reset between stages so a stage is only attributed the memory it used when it raises the mark.
+    """
+    high_water = resource.getrusage(who).ru_maxrss
+    return high_water if sys.platform == 'darwin' else high_water * 1024  # kilobytes everywhere but macOS
+
+
+def write_report():
+    output_path = config['metrics']['output']['path']
+    report = {'started': run_started.isoformat(), 'finished': datetime.now().isoformat(), 'stages': stages,
+              'counters': dict(counters)}
+    report_file = output_path + "run_report.json"
+    try:
+        with open(report_file, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=4)
+        with open(output_path + "metrics.prom", 'w', encoding='utf-8') as file:
+            file.write(prometheus_text())
+        logging.info("Exported pipeline metrics to '{}'".format(output_path))
+    except IOError:
+        logging.error("Unable to process file '{}'".format(report_file))
+        raise ValueError("There was an issue writing to the file '{}'".format(report_file))
+
+
+prometheus_metrics = [
+    ('duration_seconds', "Wall time of the pipeline stage"),
+    ('rows_in', "Rows received by the pipeline stage"),
+    ('rows_out', "Rows produced by the pipeline stage"),
+    ('rows_per_second', "Rows processed per second by the pipeline stage"),
+    ('max_rss_bytes', "High-water mark of the resident set size of the process, as of the end of the pipeline stage"),
+    ('children_max_rss_bytes', "High-water mark of the resident set size of the largest finished child process, "
+                               "as of the end of the pipeline stage"),
+    ('db_round_trips', "Database round trips made by the pipeline stage"),
+    ('db_bytes_copied', "Bytes sent to the database with COPY by the pipeline stage"),
+    ('bytes_written', "Bytes written to output files by the pipeline stage")
+]
+
+
+def prometheus_text() -> str:
+    lines = []
+    for key, description in prometheus_metrics:
+        metric = "ppr_stage_" + key
+        lines.append("# HELP {} {}".format(metric, description))
+        lines.append("# TYPE {} gauge".format(metric))
+        for recorded in stages:
+            if recorded[key] is not None:
+                lines.append('{}{{stage="{}"}} {}'.format(metric, recorded['stage'], recorded[key]))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,224 @@
+import datetime
+import logging
+from typing import List, Union, Iterator, Iterable, Set, Dict
+
+import numpy as np
+import pyarrow as pa
+
+from app import config
+from app.property_price_register import RawPropertySale
+from app.sales_batch import SalesBatch, full_price_flag, vat_exclusive_flag, new_flag
+from app.transformer import TransformedPropertySale
+from app.util import parquet
+
+epoch_ordinal = datetime.date(1970, 1, 1).toordinal()
+
+raw_schema = pa.schema([(field, pa.string()) for field in RawPropertySale.__slots__])
+transformed_schema = pa.schema([
+    ('app_id', pa.string()),
+    ('date', pa.date32()),
+    ('address', pa.string()),
+    ('postcode', pa.dictionary(pa.int32(), pa.string())),
+    ('county', pa.dictionary(pa.int32(), pa.string())),
+    ('price_cents', pa.int64()),
+    ('full_price', pa.bool_()),
+    ('vat_exclusive', pa.bool_()),
+    ('new', pa.bool_()),
+    ('size', pa.dictionary(pa.int32(), pa.string()))
+])
+categorical_columns = ['postcode', 'county', 'size']
+# the app_ids of each table, read once a run and added to as parts are appended rather than read for every batch
+stored_ids: Dict[str, Set[str]] = {}
+
+
+def persist_raw_sales(property_sales: List[RawPropertySale]) -> List[RawPropertySale]:
+    prepare_raw_sales_table()
+    return append_raw_sales(property_sales)
+
+
+def prepare_raw_sales_table():
+    directory = __directory('raw')
+    if not __append_mode():
+        parquet.drop_table(directory)
+        stored_ids.pop(directory, None)
+        logging.debug("Dropped table '{}'".format(directory))
+    parquet.create_table(directory)
+    logging.debug("Table '{}' is available".format(directory))
+
+
+def append_raw_sales(property_sales: List[RawPropertySale]) -> List[RawPropertySale]:
+    """Stores the sales and returns those that were not already stored"""
+    directory = __directory('raw')
+    if __append_mode():
+        ids = __stored_ids(directory)
+        new_sales = [sale for sale in property_sales if sale.app_id not in ids]
+        logging.debug("'{}' of '{}' raw property sales are new".format(len(new_sales), len(property_sales)))
+        property_sales = new_sales
+    if len(property_sales) != 0:
+        table = pa.table({field: pa.array([getattr(sale, field) for sale in property_sales], type=pa.string())
+                          for field in RawPropertySale.__slots__}, schema=raw_schema)
+        parquet.append_table(directory, table, compression=__compression())
+        __add_stored_ids(directory, (sale.app_id for sale in property_sales))
+    return property_sales
+
+
+def read_raw_sales() -> List[RawPropertySale]:
+    return list(stream_raw_sales())
+
+
+def stream_raw_sales() -> Iterator[RawPropertySale]:
+    directory = __directory('raw')
+    logging.debug("Streaming all raw property sales from '{}'".format(directory))
+    for record_batch in parquet.stream_batches(directory, batch_size=config['storage']['read']['itersize']):
+        yield from __create_raw_sales(record_batch)
+
+
+def read_untransformed_raw_sales() -> List[RawPropertySale]:
+    return list(stream_untransformed_raw_sales())
+
+
+def stream_untransformed_raw_sales() -> Iterator[RawPropertySale]:
+    directory = __directory('raw')
+    transformed_ids = __stored_ids(__directory('transformed'))
+    logging.debug("Streaming raw property sales from '{}' missing from '{}'".format(
+        directory, __directory('transformed')))
+    for record_batch in parquet.stream_batches(directory, batch_size=config['storage']['read']['itersize']):
+        yield from (sale for sale in __create_raw_sales(record_batch) if sale.app_id not in transformed_ids)
+
+
+def __create_raw_sales(record_batch: pa.RecordBatch) -> Iterator[RawPropertySale]:
+    columns = record_batch.to_pydict()
+    for values in zip(*(columns[field] for field in RawPropertySale.__slots__)):
+        yield RawPropertySale(*values[1:], app_id=values[0])
+
+
+def persist_transformed_sales(transformed_sales: Union[List[TransformedPropertySale], SalesBatch]):
+    prepare_transformed_sales_table()
+    append_transformed_sales(transformed_sales)
+
+
+def prepare_transformed_sales_table():
+    directory = __directory('transformed')
+    if not __append_mode():
+        parquet.drop_table(directory)
+        stored_ids.pop(directory, None)
+        logging.debug("Dropped table '{}'".format(directory))
+    parquet.create_table(directory)
+    logging.debug("Table '{}' is available".format(directory))
+
+
+def append_transformed_sales(transformed_sales: Union[List[TransformedPropertySale], SalesBatch]):
+    batch = transformed_sales if isinstance(transformed_sales, SalesBatch) else SalesBatch.from_sales(
+        transformed_sales)
+    table = __table_from_batch(batch)
+    directory = __directory('transformed')
+    if __append_mode():
+        ids = __stored_ids(directory)
+        table = table.filter(pa.array([app_id not in ids for app_id in batch.app_ids], type=pa.bool_()))
+    if table.num_rows != 0:
+        parquet.append_table(directory, table, compression=__compression())
+        __add_stored_ids(directory, table.column('app_id').to_pylist())
+
+
+def read_transformed_sales() -> List[TransformedPropertySale]:
+    return list(stream_transformed_sales())
+
+
+def stream_transformed_sales() -> Iterator[TransformedPropertySale]:
+    for batch in stream_transformed_sales_batches(config['storage']['read']['itersize']):
+        yield from (TransformedPropertySale(*row) for row in batch)
+
+
+def read_transformed_sales_batch() -> SalesBatch:
+    directory = __directory('transformed')
+    logging.debug("Reading all transformed property sales from '{}'".format(directory))
+    table = parquet.read_table(directory, transformed_schema, read_dictionary=categorical_columns)
+    batch = SalesBatch()
+    for record_batch in table.to_batches():
+        __extend_batch(batch, record_batch)
+    return batch
+
+
+def stream_transformed_sales_batches(batch_size: int) -> Iterator[SalesBatch]:
+    directory = __directory('transformed')
+    logging.debug("Streaming all transformed property sales from '{}'".format(directory))
+    for record_batch in parquet.stream_batches(directory, batch_size=batch_size, read_dictionary=categorical_columns):
+        batch = SalesBatch()
+        __extend_batch(batch, record_batch)
+        yield batch
+
+
+def stream_transformed_addresses() -> Iterator[str]:
+    directory = __directory('transformed')
+    logging.debug("Streaming transformed property sale addresses from '{}'".format(directory))
+    for record_batch in parquet.stream_batches(directory, columns=['address'],
+                                               batch_size=config['storage']['read']['itersize']):
+        yield from record_batch.column(0).to_pylist()
+
+
+def __table_from_batch(batch: SalesBatch) -> pa.Table:
+    flags = np.frombuffer(batch.flags, dtype=np.uint8)
+    return pa.table({
+        'app_id': pa.array(batch.app_ids, type=pa.string()),
+        'date': pa.array(np.frombuffer(batch.dates, dtype=np.int32) - epoch_ordinal, type=pa.int32())
+            .cast(pa.date32()),
+        'address': pa.array(batch.addresses, type=pa.string()),
+        'postcode': __dictionary(batch.postcodes, batch.postcode_category.values),
+        'county': __dictionary(batch.counties, batch.county_category.values),
+        'price_cents': pa.array(np.frombuffer(batch.prices, dtype=np.int64)),
+        'full_price': pa.array((flags & full_price_flag) != 0),
+        'vat_exclusive': pa.array((flags & vat_exclusive_flag) != 0),
+        'new': pa.array((flags & new_flag) != 0),
+        'size': __dictionary(batch.sizes, batch.size_category.values)
+    }, schema=transformed_schema)
+
+
+def __dictionary(codes, values: List[str]) -> pa.DictionaryArray:
+    # the batch codes are already dictionary indices so the categories are stored without decoding them
+    return pa.DictionaryArray.from_arrays(pa.array(np.frombuffer(codes, dtype=np.uint16).astype(np.int32)),
+                                          pa.array(values, type=pa.string()))
+
+
+def __extend_batch(batch: SalesBatch, record_batch: pa.RecordBatch):
+    columns = {name: record_batch.column(index) for index, name in enumerate(record_batch.schema.names)}
+    batch.app_ids.extend(columns['app_id'].to_pylist())
+    dates = columns['date'].cast(pa.int32()).to_numpy() + epoch_ordinal
+    batch.dates.frombytes(dates.astype(np.int32).tobytes())
+    batch.addresses.extend(columns['address'].to_pylist())
+    batch.prices.frombytes(columns['price_cents'].to_numpy().astype(np.int64).tobytes())
+    flags = np.where(columns['full_price'].to_numpy(zero_copy_only=False), full_price_flag, 0) | \
+        np.where(columns['vat_exclusive'].to_numpy(zero_copy_only=False), vat_exclusive_flag, 0) | \
+        np.where(columns['new'].to_numpy(zero_copy_only=False), new_flag, 0)
+    batch.flags.frombytes(flags.astype(np.uint8).tobytes())
+    for codes, category, column in [(batch.postcodes, batch.postcode_category, columns['postcode']),
+                                    (batch.counties, batch.county_category, columns['county']),
+                                    (batch.sizes, batch.size_category, columns['size'])]:
+        # each part has its own dictionary, re-coded into the batch category
+        recoded = np.array([category.encode(value) for value in column.dictionary.to_pylist()], dtype=np.uint16)
+        codes.frombytes(recoded[column.indices.to_numpy()].tobytes())
+
+
+def __stored_ids(directory: str) -> Set[str]:
+    if directory not in stored_ids:
+        schema = pa.schema([('app_id', pa.string())])
+        stored_ids[directory] = set(
+            parquet.read_table(directory, schema, columns=['app_id']).column('app_id').to_pylist())
+    return stored_ids[directory]
+
+
+def __add_stored_ids(directory: str, app_ids: Iterable[str]):
+    # only kept up to date once read, otherwise they are all read from the parts when first needed
+    if directory in stored_ids:
+        stored_ids[directory].update(app_ids)
+
+
+def __directory(table: str) -> str:
+    return config['storage']['parquet']['path'] + config['storage']['table'][table]
+
+
+def __compression() -> str:
+    return config['storage']['parquet']['compression']
+
+
+def __append_mode() -> bool:
+    return config['storage']['ingest']['mode'] == 'append'
@@ -2,20 +2,27 @@ import csv
 import logging
 import os
 import sys
-from typing import List
-from uuid import uuid4
+from pathlib import Path
+from typing import List, Iterator
+from hashlib import blake2b
 
 from app import config
-from app.util import remote
+from app.util import remote, iteration
 
 output_file = config['register']['csv']['output']['path'] + config['register']['csv']['output']['file']
+archive_file = config['register']['csv']['output']['path'] + config['register']['download']['archive']
 
 
 class RawPropertySale:
+    __slots__ = ('app_id', 'date', 'address', 'postcode', 'county', 'price', 'not_full_price', 'vat_exclusive',
+                 'property_description', 'size_description')
 
     def __init__(self, date: str, address: str, postcode: str, county: str, price: str,
-                 not_full_price: str, vat_exclusive: str, property_description: str, size_description: str):
-        self.app_id: str = str(uuid4())
+                 not_full_price: str, vat_exclusive: str, property_description: str, size_description: str,
+                 app_id: str = None):
+        self.app_id: str = app_id if app_id is not None else content_key(
+            date, address, postcode, county, price, not_full_price, vat_exclusive, property_description,
+            size_description)
         self.date: str = date
         self.address: str = address
         self.postcode: str = postcode
@@ -30,30 +37,63 @@ class RawPropertySale:
         return "{} - {} - {} - {}".format(self.app_id, self.date, self.address, self.price)
 
 
-def download_csv():
-    extracted_files = remote.extract_remote_zip(
+def content_key(*fields: str, occurrence: int = 0) -> str:
+    # identical rows do appear in the register so repeats are told apart by their occurrence within it
+    key = blake2b(digest_size=16)
+    for field in fields:
+        key.update(field.encode('utf-8'))
+        key.update(b'\x1f')
+    if occurrence != 0:
+        key.update(str(occurrence).encode('utf-8'))
+    return key.hexdigest()
+
+
+def download_csv() -> bool:
+    downloaded = remote.download_file(
         config['register']['download']['url'],
-        config['register']['csv']['output']['path'],
-        ssl_verify=False)
+        archive_file,
+        ssl_verify=False,
+        conditional=config['register']['download']['conditional'],
+        chunk_size=config['register']['download']['chunk-size'])
+    if not downloaded and Path(output_file).exists():
+        logging.debug("Property price register archive '{}' is unchanged".format(archive_file))
+        return False
+    extracted_files = remote.extract_zip(archive_file, config['register']['csv']['output']['path'])
     if len(extracted_files) != 1:
         logging.error("Must be only one .csv file to process")
         sys.exit(1)
     os.rename(extracted_files[0], output_file)
     logging.debug("Downloaded property price register csv to file '{}'".format(output_file))
+    return True
 
 
 def parse_csv() -> List[RawPropertySale]:
+    property_sales = list(__read_csv())
+    return property_sales  # this is quite a big list so memory limits could be an issue
+
+
+def parse_csv_batches(batch_size: int) -> Iterator[List[RawPropertySale]]:
+    return iteration.batches(__read_csv(), batch_size)
+
+
+def __read_csv() -> Iterator[RawPropertySale]:
     logging.debug("Reading property price register data from file '{}'".format(output_file))
-    property_sales = list()
     try:
         with open(output_file, 'r', encoding="cp1252") as property_price_file:  # Windows encoding
                 reader = csv.reader(property_price_file)
                 next(reader)  # skip header row with column descriptions
+                # identical rows share a date, the keys are held by date as the register isn't always in date order
+                keys = {}
                 for row in reader:
-                    property_sales.append(RawPropertySale(row[0], row[1], row[2], row[3], row[4],
-                                                          row[5], row[6], row[7], row[8]))
+                    sale = RawPropertySale(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7], row[8])
+                    date_keys = keys.setdefault(sale.date, set())
+                    occurrence = 0
+                    while sale.app_id in date_keys:
+                        occurrence += 1
+                        sale.app_id = content_key(*row[:9], occurrence=occurrence)
+                    date_keys.add(sale.app_id)
+                    yield sale
     except IOError:
         logging.error("Unable to process file '{}'".format(output_file))
         raise ValueError("There was an issue reading from the file '{}'".format(output_file))
     logging.debug("Consumed property price register data from file '{}'".format(output_file))
-    return property_sales  # this is quite a big list so memory limits could be an issue
@@ -0,0 +1,117 @@
+import datetime
+import sys
+from array import array
+from decimal import Decimal
+from typing import List, Iterable, Iterator, Tuple
+
+full_price_flag = 1
+vat_exclusive_flag = 2
+new_flag = 4
+
+
+class Category:
+    __slots__ = ('values', 'codes')
+
+    def __init__(self):
+        self.values: List[str] = []
+        self.codes = {}
+
+    def encode(self, value: str) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            value = sys.intern(value)
+            self.values.append(value)
+            self.codes[value] = code
+        return code
+
+    def decode(self, code: int) -> str:
+        return self.values[code]
+
+
+class SalesBatch:
+    """Columnar store of transformed property sales, with one compact array per column.
+
+    Rows are read back as tuples in the column order of TransformedPropertySale. Dates are kept as proleptic
+    Gregorian ordinals, prices as integer cents, the boolean fields as a bitmask and the low-cardinality postcode,
+    county and size fields as codes into a per-batch category.
+    """
+
+    def __init__(self):
+        self.app_ids: List[str] = []
+        self.dates = array('i')
+        self.addresses: List[str] = []
+        self.postcodes = array('H')
+        self.counties = array('H')
+        self.prices = array('q')
+        self.flags = array('B')
+        self.sizes = array('H')
+        self.postcode_category = Category()
+        self.county_category = Category()
+        self.size_category = Category()
+
+    @classmethod
+    def from_sales(cls, sales: Iterable) -> 'SalesBatch':
+        batch = cls()
+        batch.extend(sales)
+        return batch
+
+    def append_values(self, app_id: str, date: datetime.date, address: str, postcode: str, county: str,
+                      price: Decimal, full_price: bool, vat_exclusive: bool, new: bool, size: str):
+        self.app_ids.append(app_id)
+        self.dates.append(date.toordinal())
+        self.addresses.append(address)
+        self.postcodes.append(self.postcode_category.encode(postcode))
+        self.counties.append(self.county_category.encode(county))
+        self.prices.append(to_cents(price))
+        self.flags.append((full_price_flag if full_price else 0) | (vat_exclusive_flag if vat_exclusive else 0) |
+                          (new_flag if new else 0))
+        self.sizes.append(self.size_category.encode(size))
+
+    def append(self, sale):
+        self.append_values(sale.app_id, sale.date, sale.address, sale.postcode, sale.county, sale.price,
+                           sale.full_price, sale.vat_exclusive, sale.new, sale.size)
+
+    def extend(self, sales: Iterable):
+        for sale in sales:
+            self.append(sale)
+
+    def extend_batch(self, other: 'SalesBatch'):
+        self.app_ids.extend(other.app_ids)
+        self.dates.extend(other.dates)
+        self.addresses.extend(other.addresses)
+        self.prices.extend(other.prices)
+        self.flags.extend(other.flags)
+        for codes, category, other_codes, other_category in [
+                (self.postcodes, self.postcode_category, other.postcodes, other.postcode_category),
+                (self.counties, self.county_category, other.counties, other.county_category),
+                (self.sizes, self.size_category, other.sizes, other.size_category)]:
+            recoded = [category.encode(value) for value in other_category.values]
+            codes.extend(recoded[code] for code in other_codes)
+
+    def row(self, index: int) -> Tuple:
+        flags = self.flags[index]
+        return (self.app_ids[index], datetime.date.fromordinal(self.dates[index]), self.addresses[index],
+                self.postcode_category.decode(self.postcodes[index]), self.county_category.decode(self.counties[index]),
+                from_cents(self.prices[index]), bool(flags & full_price_flag), bool(flags & vat_exclusive_flag),
+                bool(flags & new_flag), self.size_category.decode(self.sizes[index]))
+
+    def __getitem__(self, index: int) -> Tuple:
+        return self.row(index)
+
+    def __iter__(self) -> Iterator[Tuple]:
+        return (self.row(index) for index in range(len(self)))
+
+    def __len__(self):
+        return len(self.app_ids)
+
+
+def to_cents(price: Decimal) -> int:
+    cents = price.scaleb(2)
+    if cents != cents.to_integral_value():
+        raise ValueError("Price '{}' has a fraction of a cent".format(price))
+    return int(cents)
+
+
+def from_cents(cents: int) -> Decimal:
+    return Decimal(cents).scaleb(-2)
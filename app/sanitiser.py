@@ -1,5 +1,7 @@
 import logging
 import re
+from collections import Counter
+from typing import List, Tuple, Dict
 
 from app.property_price_register import RawPropertySale
 
@@ -11,14 +13,48 @@ class Sanitiser:
         self.__raw_property_sale = raw_property_sale
 
     def sanitise(self) -> RawPropertySale:
-        sale = self.__raw_property_sale
-        sale.address = self.sanitise_address(sale.address, sale.app_id)
-        sale.postcode = self.sanitise_postcode(sale.postcode, sale.app_id)
-        sale.price = self.sanitise_price(sale.price, sale.app_id)
-        sale.property_description = self.sanitise_property_description(sale.property_description, sale.app_id)
-        sale.size_description = self.sanitise_size_description(sale.size_description, sale.app_id)
+        return self.sanitise_sale(self.__raw_property_sale)
+
+    @classmethod
+    def sanitise_sale(cls, sale: RawPropertySale) -> RawPropertySale:
+        sale.address = cls.sanitise_address(sale.address, sale.app_id)
+        sale.postcode = cls.sanitise_postcode(sale.postcode, sale.app_id)
+        sale.price = cls.sanitise_price(sale.price, sale.app_id)
+        sale.property_description = cls.sanitise_property_description(sale.property_description, sale.app_id)
+        sale.size_description = cls.sanitise_size_description(sale.size_description, sale.app_id)
         return sale
 
+    @classmethod
+    def sanitise_sales(cls, sales: List[RawPropertySale]) -> List[RawPropertySale]:
+        return [cls.sanitise_sale(sale) for sale in sales]
+
+    # raw value -> (canonical value, whether it is unusual), these columns only have a few dozen distinct values
+    lookups: Dict[str, Dict[str, Tuple[str, bool]]] = {
+        'postcode': {}, 'property description': {}, 'size description': {}
+    }
+
+    # (column, raw value) -> number of sales, logged once per run rather than once per sale
+    anomalies = Counter()
+
+    @classmethod
+    def record_anomaly(cls, column: str, value: str, count: int = 1):
+        cls.anomalies[(column, value)] += count
+
+    @classmethod
+    def log_anomalies(cls):
+        for (column, value), count in sorted(cls.anomalies.items()):
+            logging.warning("Unusual {} '{}' on '{}' sales".format(column, value, count))
+        cls.anomalies.clear()
+
+    @classmethod
+    def __lookup(cls, column: str, value: str, resolve) -> str:
+        resolved = cls.lookups[column].get(value)
+        if resolved is None:
+            resolved = cls.lookups[column][value] = resolve(value)
+        if resolved[1]:
+            cls.record_anomaly(column, value)
+        return resolved[0]
+
     regexes = {
         'postcode': {
             'dublin': {
@@ -62,53 +98,53 @@ class Sanitiser:
 
     @classmethod
     def sanitise_postcode(cls, postcode: str, identifier: str = None) -> str:
+        return cls.__lookup('postcode', postcode, cls.__resolve_postcode)
+
+    @classmethod
+    def __resolve_postcode(cls, postcode: str) -> Tuple[str, bool]:
         if cls.regexes['postcode']['dublin']['gaeilge'].match(postcode):
-            # logging.debug("Sanitising '{}' of '{}'".format(postcode, identifier))
-            return cls.regexes['postcode']['dublin']['gaeilge'].sub('Dublin', postcode)
+            return cls.regexes['postcode']['dublin']['gaeilge'].sub('Dublin', postcode), False
         elif cls.regexes['postcode']['none']['gaeilge'].match(postcode):
-            # logging.debug("Sanitising '{}' of '{}'".format(postcode, identifier))
-            return cls.regexes['postcode']['none']['gaeilge'].sub('', postcode)
-        elif len(postcode) > 0 and cls.regexes['postcode']['dublin']['bearla'].match(postcode) is None:
-            logging.warning("Unusual postcode '{}' of '{}'".format(postcode, identifier))
-        return postcode
+            return cls.regexes['postcode']['none']['gaeilge'].sub('', postcode), False
+        return postcode, len(postcode) > 0 and cls.regexes['postcode']['dublin']['bearla'].match(postcode) is None
 
     @classmethod
     def sanitise_price(cls, price: str, identifier: str = None) -> str:
-        if cls.regexes['price'].match(price) is None:
-            logging.warning("Unusual price '{}' of '{}'".format(price, identifier))
+        if cls.regexes['price'].match(price) is None:  # too many distinct prices for a lookup
+            cls.record_anomaly('price', price)
         return price
 
     @classmethod
     def sanitise_property_description(cls, property_description: str, identifier: str = None) -> str:
+        return cls.__lookup('property description', property_description, cls.__resolve_property_description)
+
+    @classmethod
+    def __resolve_property_description(cls, property_description: str) -> Tuple[str, bool]:
         if cls.regexes['description']['new']['gaeilge'].match(property_description):
-            # logging.debug("Sanitising '{}' of '{}'".format(property_description, identifier))
             return cls.regexes['description']['new']['gaeilge'].sub('New Dwelling house /Apartment',
-                                                                    property_description)
+                                                                    property_description), False
         elif cls.regexes['description']['used']['gaeilge'].match(property_description):
-            # logging.debug("Sanitising '{}' of '{}'".format(property_description, identifier))
             return cls.regexes['description']['used']['gaeilge'].sub('Second-Hand Dwelling house /Apartment',
-                                                                     property_description)
-        elif cls.regexes['description']['new']['bearla'].match(property_description) is None and \
-                cls.regexes['description']['used']['bearla'].match(property_description) is None:
-            logging.warning("Unusual property description '{}' of '{}'".format(property_description, identifier))
-        return property_description
+                                                                     property_description), False
+        return property_description, \
+            cls.regexes['description']['new']['bearla'].match(property_description) is None and \
+            cls.regexes['description']['used']['bearla'].match(property_description) is None
 
     @classmethod
     def sanitise_size_description(cls, size_description: str, identifier: str = None) -> str:
+        return cls.__lookup('size description', size_description, cls.__resolve_size_description)
+
+    @classmethod
+    def __resolve_size_description(cls, size_description: str) -> Tuple[str, bool]:
         if cls.regexes['size']['large']['bearla'].match(size_description):
-            # logging.debug("Sanitising '{}' of '{}'".format(size_description, identifier))
             return cls.regexes['size']['large']['bearla'].sub('greater than or equal to 125 sq metres',
-                                                              size_description)
+                                                              size_description), False
         elif cls.regexes['size']['medium']['gaeilge'].match(size_description):
-            # logging.debug("Sanitising '{}' of '{}'".format(size_description, identifier))
             return cls.regexes['size']['medium']['gaeilge'] \
-                .sub('greater than or equal to 38 sq metres and less than 125 sq metres', size_description)
+                .sub('greater than or equal to 38 sq metres and less than 125 sq metres', size_description), False
         elif cls.regexes['size']['small']['gaeilge'].match(size_description):
-            # logging.debug("Sanitising '{}' of '{}'".format(size_description, identifier))
-            return cls.regexes['size']['small']['gaeilge'].sub('less than 38 sq metres', size_description)
-        elif len(size_description) > 0 and \
-                cls.regexes['size']['large']['bearla'].match(size_description) is None and \
-                cls.regexes['size']['medium']['bearla'].match(size_description) is None and \
-                cls.regexes['size']['small']['bearla'].match(size_description) is None:
-            logging.warning("Unusual size description '{}' of '{}'".format(size_description, identifier))
-        return size_description
+            return cls.regexes['size']['small']['gaeilge'].sub('less than 38 sq metres', size_description), False
+        return size_description, len(size_description) > 0 and \
+            cls.regexes['size']['large']['bearla'].match(size_description) is None and \
+            cls.regexes['size']['medium']['bearla'].match(size_description) is None and \
+            cls.regexes['size']['small']['bearla'].match(size_description) is None
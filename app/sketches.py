@@ -0,0 +1,177 @@
+import datetime
+import json
+import logging
+import math
+from collections import Counter
+from typing import Dict, Tuple, Iterator
+
+import numpy as np
+
+from app import config, metrics
+from app.sales_batch import SalesBatch, full_price_flag, new_flag
+
+epoch_ordinal = datetime.date(1970, 1, 1).toordinal()
+
+
+class QuantileSketch:
+    """Mergeable quantile sketch over logarithmic buckets, in the manner of DDSketch.
+
+    Every quantile it answers is within the relative accuracy of the sale price at that rank, e.g. a median of 200,000
+    with a relative accuracy of 0.01 is somewhere between 198,000 and 202,000. Merging two sketches just adds their
+    buckets, so new sales are folded in without the sales already counted.
+    """
+    __slots__ = ('relative_accuracy', 'gamma', 'buckets', 'zero_count', 'count', 'sum', 'min', 'max')
+
+    def __init__(self, relative_accuracy: float):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.buckets = Counter()
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add_values(self, values: np.ndarray):
+        if len(values) == 0:
+            return
+        positive = values[values > 0]
+        self.zero_count += len(values) - len(positive)
+        indices, counts = np.unique(np.ceil(np.log(positive) / math.log(self.gamma)).astype(np.int64),
+                                    return_counts=True)
+        self.buckets.update(dict(zip(indices.tolist(), counts.tolist())))
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+    def merge(self, other: 'QuantileSketch'):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Sketches with relative accuracies '{}' and '{}' can't be merged".format(
+                self.relative_accuracy, other.relative_accuracy))
+        self.buckets.update(other.buckets)
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, quantile: float) -> float:
+        if self.count == 0:
+            return math.nan
+        rank = quantile * (self.count - 1)
+        if rank < self.zero_count:
+            return 0.0
+        seen = self.zero_count
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                # the value the whole bucket is within relative accuracy of, kept within what was actually seen
+                return min(max(2 * self.gamma ** index / (self.gamma + 1), self.min), self.max)
+        return self.max
+
+    def to_dict(self) -> Dict:
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'zero_count': self.zero_count, 'buckets': {str(index): count for index, count in self.buckets.items()}}
+
+    @classmethod
+    def from_dict(cls, relative_accuracy: float, values: Dict) -> 'QuantileSketch':
+        sketch = cls(relative_accuracy)
+        sketch.count, sketch.sum, sketch.min, sketch.max = values['count'], values['sum'], values['min'], values['max']
+        sketch.zero_count = values['zero_count']
+        sketch.buckets = Counter({int(index): count for index, count in values['buckets'].items()})
+        return sketch
+
+
+class SketchStore:
+    """Price sketches for each (month, county, new, full price) cell, along with the number of sales folded in"""
+
+    def __init__(self, relative_accuracy: float):
+        self.relative_accuracy = relative_accuracy
+        self.cells: Dict[Tuple[str, str, bool, bool], QuantileSketch] = {}
+        self.sales = 0
+
+    def fold(self, batch: SalesBatch):
+        if len(batch) == 0:
+            return
+        months = (np.frombuffer(batch.dates, dtype=np.int32) - epoch_ordinal).astype('datetime64[D]') \
+            .astype('datetime64[M]')
+        flags = np.frombuffer(batch.flags, dtype=np.uint8)
+        codes = cell_codes(months, np.frombuffer(batch.counties, dtype=np.uint16), flags)
+        prices = np.frombuffer(batch.prices, dtype=np.int64) / 100
+        order = np.argsort(codes, kind='stable')
+        _, starts = np.unique(codes[order], return_index=True)
+        for position, start in enumerate(starts):
+            end = starts[position + 1] if position + 1 < len(starts) else len(order)
+            first = order[start]
+            key = (str(months[first]), batch.county_category.decode(batch.counties[first]),
+                   bool(flags[first] & new_flag), bool(flags[first] & full_price_flag))
+            sketch = self.cells.get(key)
+            if sketch is None:
+                sketch = self.cells[key] = QuantileSketch(self.relative_accuracy)
+            sketch.add_values(prices[order[start:end]])
+        self.sales += len(batch)
+        logging.debug("Folded '{}' sales into '{}' sketch cells".format(len(batch), len(self.cells)))
+
+    def merged(self, month: str = None, county: str = None, new: bool = None,
+               full_price: bool = None) -> QuantileSketch:
+        """Merges the cells matching every given part of the key, e.g. all the new sales in a county"""
+        merged = QuantileSketch(self.relative_accuracy)
+        for sketch in self.__matching(month, county, new, full_price):
+            merged.merge(sketch)
+        return merged
+
+    def quantile(self, quantile: float, month: str = None, county: str = None, new: bool = None,
+                 full_price: bool = None) -> float:
+        return self.merged(month, county, new, full_price).quantile(quantile)
+
+    def __matching(self, month, county, new, full_price) -> Iterator[QuantileSketch]:
+        for (cell_month, cell_county, cell_new, cell_full_price), sketch in self.cells.items():
+            if (month is None or month == cell_month) and (county is None or county == cell_county) and \
+                    (new is None or new == cell_new) and (full_price is None or full_price == cell_full_price):
+                yield sketch
+
+
+def cell_codes(months: np.ndarray, counties: np.ndarray, flags: np.ndarray) -> np.ndarray:
+    # a single integer per cell so the sales are split into their cells with one sort
+    return (months.astype(np.int64) * 65536 + counties) * 4 + ((flags & new_flag) != 0) * 2 + \
+        ((flags & full_price_flag) != 0)
+
+
+def sketch_file() -> str:
+    return config['analysis']['sketches']['path'] + "sketches.json"
+
+
+def load() -> SketchStore:
+    relative_accuracy = config['analysis']['sketches']['relative-accuracy']
+    store = SketchStore(relative_accuracy)
+    try:
+        with open(sketch_file(), 'r', encoding='utf-8') as file:
+            stored = json.load(file)
+    except FileNotFoundError:
+        logging.debug("No sketches stored at '{}' yet".format(sketch_file()))
+        return store
+    if stored['relative-accuracy'] != relative_accuracy:
+        logging.warning("Ignoring sketches stored with relative accuracy '{}'".format(stored['relative-accuracy']))
+        return store
+    store.sales = stored['sales']
+    for cell in stored['cells']:
+        store.cells[(cell['month'], cell['county'], cell['new'], cell['full_price'])] = \
+            QuantileSketch.from_dict(relative_accuracy, cell['sketch'])
+    return store
+
+
+def save(store: SketchStore):
+    output_file = sketch_file()
+    stored = {'relative-accuracy': store.relative_accuracy, 'sales': store.sales,
+              'cells': [{'month': month, 'county': county, 'new': new, 'full_price': full_price,
+                         'sketch': sketch.to_dict()}
+                        for (month, county, new, full_price), sketch in store.cells.items()]}
+    try:
+        with open(output_file, 'w', encoding='utf-8') as file:
+            json.dump(stored, file)
+        metrics.record_file(output_file)
+        logging.info("Stored sketches of '{}' sales to '{}'".format(store.sales, output_file))
+    except IOError:
+        logging.error("Unable to process file '{}'".format(output_file))
+        raise ValueError("There was an issue writing to the file '{}'".format(output_file))
@@ -1,37 +1,88 @@
+import functools
 import logging
-from typing import List
+from typing import List, Union, Iterator
 
 from app import config, get_connection
 from app.property_price_register import RawPropertySale
+from app.sales_batch import SalesBatch
 from app.transformer import TransformedPropertySale
 from app.util import postgres
 
 
-def persist_raw_sales(property_sales: List[RawPropertySale]):
+def persist_raw_sales(property_sales: List[RawPropertySale]) -> List[RawPropertySale]:
+    prepare_raw_sales_table()
+    return append_raw_sales(property_sales)
+
+
+def prepare_raw_sales_table():
     table_name = config['storage']['table']['raw']
-    postgres.drop_table(get_connection(), table_name)
-    logging.debug("Dropped table '{}'".format(table_name))
-    __create_raw_sale_table(table_name)
+    with get_connection() as connection:
+        if not __append_mode():
+            postgres.drop_table(connection, table_name)
+            logging.debug("Dropped table '{}'".format(table_name))
+        __create_raw_sale_table(connection, table_name)
     logging.debug("Table '{}' is available".format(table_name))
-    __insert_raw_property_sales(table_name, property_sales)
+
+
+def append_raw_sales(property_sales: List[RawPropertySale]) -> List[RawPropertySale]:
+    """Stores the sales and returns those that were not already stored"""
+    table_name = config['storage']['table']['raw']
+    if not __append_mode():
+        __insert_raw_property_sales(table_name, property_sales)
+        return property_sales
+    stored = __insert_raw_property_sales(table_name, property_sales, skip_existing=True)
+    stored_ids = set(db_tuple[0] for db_tuple in stored)
+    logging.debug("'{}' of '{}' raw property sales are new".format(len(stored_ids), len(property_sales)))
+    return [sale for sale in property_sales if sale.app_id in stored_ids]
+
+
+def __loader():
+    # execute_values unless COPY is chosen
+    if config['storage']['loader']['type'] == 'copy':
+        return functools.partial(postgres.copy_insert, buffer_size=config['storage']['loader']['buffer-size'])
+    return postgres.bulk_insert
+
+
+def __append_mode() -> bool:
+    return config['storage']['ingest']['mode'] == 'append'
 
 
 def read_raw_sales() -> List[RawPropertySale]:
+    return list(stream_raw_sales())
+
+
+def stream_raw_sales() -> Iterator[RawPropertySale]:
+    table_name = config['storage']['table']['raw']
+    logging.debug("Streaming all raw property sales from '{}'".format(table_name))
+    with get_connection() as connection:
+        for db_tuple in postgres.stream_all(connection, table_name, itersize=config['storage']['read']['itersize']):
+            yield __create_raw_sale_from_db(db_tuple)
+
+
+def read_untransformed_raw_sales() -> List[RawPropertySale]:
+    return list(stream_untransformed_raw_sales())
+
+
+def stream_untransformed_raw_sales() -> Iterator[RawPropertySale]:
     table_name = config['storage']['table']['raw']
-    logging.debug("Reading all raw property sales from '{}'".format(table_name))
-    sales = postgres.read_all(get_connection(), table_name)
-    return [__create_raw_sale_from_db(db_tuple) for db_tuple in sales]
+    transformed_table_name = config['storage']['table']['transformed']
+    logging.debug("Streaming raw property sales from '{}' missing from '{}'".format(
+        table_name, transformed_table_name))
+    with get_connection() as connection:
+        # the first append run reads raw sales before anything has created the transformed table
+        __create_transformed_sales_table(connection, transformed_table_name)
+        for db_tuple in postgres.stream_all_missing(connection, table_name, transformed_table_name, 'app_id',
+                                                    itersize=config['storage']['read']['itersize']):
+            yield __create_raw_sale_from_db(db_tuple)
 
 
 def __create_raw_sale_from_db(db_tuple) -> RawPropertySale:
-    instance = RawPropertySale(db_tuple[2], db_tuple[3], db_tuple[4], db_tuple[5], db_tuple[6], db_tuple[7],
-                               db_tuple[8], db_tuple[9], db_tuple[10])
-    instance.app_id = db_tuple[1]
-    return instance
+    return RawPropertySale(db_tuple[2], db_tuple[3], db_tuple[4], db_tuple[5], db_tuple[6], db_tuple[7],
+                           db_tuple[8], db_tuple[9], db_tuple[10], app_id=db_tuple[1])
 
 
-def __create_raw_sale_table(table_name: str):
-    postgres.create_table(get_connection(), table_name,
+def __create_raw_sale_table(connection, table_name: str):
+    postgres.create_table(connection, table_name,
                           ["id serial PRIMARY KEY",
                            "app_id varchar(36) NOT NULL UNIQUE",
                            "date varchar(20)",
@@ -46,29 +97,79 @@ def __create_raw_sale_table(table_name: str):
                            ])
 
 
-def __insert_raw_property_sales(table_name: str, property_sales: List[RawPropertySale]):
-    postgres.bulk_insert(get_connection(), table_name,
-                         ["app_id", "date", "address", "postcode", "county", "price", "not_full_price", "vat_exclusive",
-                          "property_description", "size_description"],
-                         ((sale.app_id, sale.date, sale.address, sale.postcode, sale.county, sale.price,
-                           sale.not_full_price, sale.vat_exclusive, sale.property_description, sale.size_description)
-                          for sale in property_sales))
+def __insert_raw_property_sales(table_name: str, property_sales: List[RawPropertySale], skip_existing=False):
+    insert = __loader()
+    with get_connection() as connection:
+        return insert(connection, table_name,
+                      ["app_id", "date", "address", "postcode", "county", "price", "not_full_price", "vat_exclusive",
+                       "property_description", "size_description"],
+                      ((sale.app_id, sale.date, sale.address, sale.postcode, sale.county, sale.price,
+                        sale.not_full_price, sale.vat_exclusive, sale.property_description, sale.size_description)
+                       for sale in property_sales),
+                      conflict_column='app_id' if skip_existing else None,
+                      returning='app_id' if skip_existing else None)
 
 
-def persist_transformed_sales(transformed_sales: List[TransformedPropertySale]):
+def persist_transformed_sales(transformed_sales: Union[List[TransformedPropertySale], SalesBatch]):
+    prepare_transformed_sales_table()
+    append_transformed_sales(transformed_sales)
+
+
+def prepare_transformed_sales_table():
     table_name = config['storage']['table']['transformed']
-    postgres.drop_table(get_connection(), table_name)
-    logging.debug("Dropped table '{}'".format(table_name))
-    __create_transformed_sales_table(table_name)
+    with get_connection() as connection:
+        if not __append_mode():
+            postgres.drop_table(connection, table_name)
+            logging.debug("Dropped table '{}'".format(table_name))
+        __create_transformed_sales_table(connection, table_name)
     logging.debug("Table '{}' is available".format(table_name))
-    __insert_transformed_sales(table_name, transformed_sales)
+
+
+def append_transformed_sales(transformed_sales: Union[List[TransformedPropertySale], SalesBatch]):
+    __insert_transformed_sales(config['storage']['table']['transformed'], transformed_sales,
+                               skip_existing=__append_mode())
 
 
 def read_transformed_sales() -> List[TransformedPropertySale]:
+    return list(stream_transformed_sales())
+
+
+def stream_transformed_sales() -> Iterator[TransformedPropertySale]:
+    return (__create_transformed_sale_from_db(db_tuple) for db_tuple in __stream_transformed_rows())
+
+
+def read_transformed_sales_batch() -> SalesBatch:
+    batch = SalesBatch()
+    for db_tuple in __stream_transformed_rows():
+        batch.append_values(*db_tuple[1:11])
+    return batch
+
+
+def stream_transformed_sales_batches(batch_size: int) -> Iterator[SalesBatch]:
+    batch = SalesBatch()
+    for db_tuple in __stream_transformed_rows():
+        batch.append_values(*db_tuple[1:11])
+        if len(batch) == batch_size:
+            yield batch
+            batch = SalesBatch()
+    if len(batch) != 0:
+        yield batch
+
+
+def stream_transformed_addresses() -> Iterator[str]:
+    table_name = config['storage']['table']['transformed']
+    logging.debug("Streaming transformed property sale addresses from '{}'".format(table_name))
+    with get_connection() as connection:
+        for db_tuple in postgres.stream_all(connection, table_name, columns=['address'],
+                                            itersize=config['storage']['read']['itersize']):
+            yield db_tuple[0]
+
+
+def __stream_transformed_rows() -> Iterator:
     table_name = config['storage']['table']['transformed']
-    logging.debug("Reading all transformed property sales from '{}'".format(table_name))
-    sales = postgres.read_all(get_connection(), table_name)
-    return [__create_transformed_sale_from_db(db_tuple) for db_tuple in sales]
+    logging.debug("Streaming all transformed property sales from '{}'".format(table_name))
+    with get_connection() as connection:
+        yield from postgres.stream_all(connection, table_name, itersize=config['storage']['read']['itersize'])
 
 
 def __create_transformed_sale_from_db(db_tuple) -> TransformedPropertySale:
@@ -76,8 +177,8 @@ def __create_transformed_sale_from_db(db_tuple) -> TransformedPropertySale:
                                    db_tuple[7], db_tuple[8], db_tuple[9], db_tuple[10])
 
 
-def __create_transformed_sales_table(table_name: str):
-    postgres.create_table(get_connection(), table_name,
+def __create_transformed_sales_table(connection, table_name: str):
+    postgres.create_table(connection, table_name,
                           ["id serial PRIMARY KEY",
                            "app_id varchar(36) NOT NULL UNIQUE",
                            "date date",
@@ -92,10 +193,18 @@ def __create_transformed_sales_table(table_name: str):
                            ])
 
 
-def __insert_transformed_sales(table_name: str, property_sales: List[TransformedPropertySale]):
-    postgres.bulk_insert(get_connection(), table_name,
-                         ["app_id", "date", "address", "postcode", "county", "price", "full_price", "vat_exclusive",
-                          "new", "size"],
-                         ((sale.app_id, sale.date, sale.address, sale.postcode, sale.county, sale.price,
-                           sale.full_price, sale.vat_exclusive, sale.new, sale.size)
-                          for sale in property_sales))
+def __insert_transformed_sales(table_name: str, property_sales: Union[List[TransformedPropertySale], SalesBatch],
+                               skip_existing=False):
+    if isinstance(property_sales, SalesBatch):
+        values = iter(property_sales)  # rows are already in column order
+    else:
+        values = ((sale.app_id, sale.date, sale.address, sale.postcode, sale.county, sale.price,
+                   sale.full_price, sale.vat_exclusive, sale.new, sale.size)
+                  for sale in property_sales)
+    insert = __loader()
+    with get_connection() as connection:
+        insert(connection, table_name,
+               ["app_id", "date", "address", "postcode", "county", "price", "full_price", "vat_exclusive", "new",
+                "size"],
+               values,
+               conflict_column='app_id' if skip_existing else None)
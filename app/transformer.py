@@ -1,10 +1,13 @@
 import datetime
-import logging
+import functools
 import re
 import string
 from decimal import Decimal
+from typing import Iterable
 
+from app import config
 from app.property_price_register import RawPropertySale
+from app.sales_batch import SalesBatch
 
 
 def transform_date(date: str) -> datetime:
@@ -33,62 +36,86 @@ def transform_price(price: str) -> Decimal:
 
 # all should be not be surrounded by more words
 address_abbreviations = {
-    re.compile(r"\s+Apts\s+"): "Apartments",
-    re.compile(r"\s+Ave\s+"): "Avenue",
-    re.compile(r"\s+Ave\s+"): "Avenue",
-    re.compile(r"\s+Blvd\s+"): "Boulevard",
-    re.compile(r"\s+Bldg\s+"): "Building",
-    re.compile(r"\s+Ct\s+"): "Court",
-    re.compile(r"\s+Cts\s+"): "Courts",
-    re.compile(r"\s+Cres\s+"): "Crescent",
-    re.compile(r"\s+Dr\s+"): "Drive",
-    re.compile(r"\s+Est\s+"): "Estate",
-    re.compile(r"\s+Ft\s+"): "Fort",
-    re.compile(r"\s+Frnt\s+"): "Front",
-    re.compile(r"\s+Gdn\s+"): "Garden",
-    re.compile(r"\s+Gdns\s+"): "Gardens",
-    re.compile(r"\s+Gln\s+"): "Glen",
-    re.compile(r"\s+Grv\s+"): "Grove",
-    re.compile(r"\s+Grvs\s+"): "Groves",
-    re.compile(r"\s+Hvn\s+"): "Haven",
-    re.compile(r"\s+Hts\s+"): "Heights",
-    re.compile(r"\s+Hl\s+"): "Hill",
-    re.compile(r"\s+Hls\s+"): "Hills",
-    re.compile(r"\s+Hse\s+"): "House",
-    re.compile(r"\s+Isl\s+"): "Island",
-    re.compile(r"\s+Ln\s+"): "Lane",
-    re.compile(r"\s+Ldg\s+"): "Lodge",
-    re.compile(r"\s+Lwr\s+"): "Lower",
-    re.compile(r"\s+Mnr\s+"): "Manor",
-    re.compile(r"\s+Mdw\s+"): "Meadow",
-    re.compile(r"\s+Mdws\s+"): "Meadows",
-    re.compile(r"\s+Mls\s+"): "Mills",
-    re.compile(r"\s+Mt\s+"): "Mount",
-    re.compile(r"\s+Orch\s+"): "Orchard",
-    re.compile(r"\s+Pk\s+"): "Park",
-    re.compile(r"\s+Pl\s+"): "Place",
-    re.compile(r"\s+Plz\s+"): "Plaza",
-    re.compile(r"\s+Pt\s+"): "Point",
-    re.compile(r"\s+Riv\s+"): "River",
-    re.compile(r"\s+Rd\s+"): "Road",
-    re.compile(r"\s+Sq\s+"): "Square",
-    re.compile(r"\s+Spr\s+"): "Spring",
-    re.compile(r"\s+Spg\s+"): "Spring",
-    re.compile(r"\s+Spgs\s+"): "Springs",
-    re.compile(r"\s+Sta\s+"): "Station",
-    re.compile(r"(?<!\d)\s+St\s+"): "Street",  # not first or after number, more than likely saint
-    re.compile(r"\s+Ter\s+"): "Terrace",
-    re.compile(r"\s+Uppr\s+"): "Upper",
-    re.compile(r"\s+Vw\s+"): "View",
-    re.compile(r"\s+Vlg\s+"): "Village"
+    "Apts": "Apartments",
+    "Ave": "Avenue",
+    "Blvd": "Boulevard",
+    "Bldg": "Building",
+    "Ct": "Court",
+    "Cts": "Courts",
+    "Cres": "Crescent",
+    "Dr": "Drive",
+    "Est": "Estate",
+    "Ft": "Fort",
+    "Frnt": "Front",
+    "Gdn": "Garden",
+    "Gdns": "Gardens",
+    "Gln": "Glen",
+    "Grv": "Grove",
+    "Grvs": "Groves",
+    "Hvn": "Haven",
+    "Hts": "Heights",
+    "Hl": "Hill",
+    "Hls": "Hills",
+    "Hse": "House",
+    "Isl": "Island",
+    "Ln": "Lane",
+    "Ldg": "Lodge",
+    "Lwr": "Lower",
+    "Mnr": "Manor",
+    "Mdw": "Meadow",
+    "Mdws": "Meadows",
+    "Mls": "Mills",
+    "Mt": "Mount",
+    "Orch": "Orchard",
+    "Pk": "Park",
+    "Pl": "Place",
+    "Plz": "Plaza",
+    "Pt": "Point",
+    "Riv": "River",
+    "Rd": "Road",
+    "Sq": "Square",
+    "Spr": "Spring",
+    "Spg": "Spring",
+    "Spgs": "Springs",
+    "Sta": "Station",
+    "Ter": "Terrace",
+    "Uppr": "Upper",
+    "Vw": "View",
+    "Vlg": "Village"
 }
 
+# one pass over the address for every abbreviation, a token directly after a replaced one has had its leading
+# whitespace consumed so it is also matched when preceded by whitespace
+abbreviations_regex = re.compile(
+    r"(?:(?P<lead>\s+)|(?<=\s))(?P<token>" + "|".join(map(re.escape, address_abbreviations)) + r")\s+"
+    r"|(?:(?P<saint_lead>(?<!\d)\s+)|(?<=\s)(?<!\d\s))(?P<saint>St)\s+")  # not first or after number, likely saint
+
+
+def __replace_abbreviations(address: str) -> str:
+    # a pass for each abbreviation would leave the second of a repeated pair, e.g. the Saint of Main St St Annes, so
+    # a token matched straight after the same token was expanded is left as it is
+    expanded = [-1, None]  # where the last expanded token ended, and which it was
+
+    def replace(match) -> str:
+        token = match.group('token') or match.group('saint')
+        if match.start() == expanded[0] and token == expanded[1] and \
+                match.group('lead') is None and match.group('saint_lead') is None:
+            expanded[0] = -1
+            return match.group()
+        expanded[0], expanded[1] = match.end(), token
+        if match.group('saint') is not None:
+            return (" " if match.group('saint_lead') is not None else "") + "Street "
+        return (" " if match.group('lead') is not None else "") + address_abbreviations[token] + " "
+    return abbreviations_regex.sub(replace, address)
+
+
 start_regex = re.compile(r'^\s*(Apts?|Apartments?|Flts?|Flats?|Nos?|Nums?|Numbers?|Houses?)', flags=re.IGNORECASE)
 non_valid_regex = re.compile(r'([^\s\d\w])')
 county_regex = re.compile(r'Co(?<=\w)(?!\w)', flags=re.IGNORECASE)
 multiples_regex = re.compile(r'^(\d+(\w{1})?(\s*And)?\W+){2,}', flags=re.IGNORECASE)
 
 
+@functools.lru_cache(maxsize=config['data_clean']['address']['cache-size'])  # the same addresses recur in resales
 def transform_address(address: str, postcode: str, county: str) -> str:
     new_address = address
     if non_valid_regex.search(new_address):
@@ -106,13 +133,52 @@ def transform_address(address: str, postcode: str, county: str) -> str:
         new_address += " " + postcode  # add post code
     if county not in new_address:
         new_address += " " + county  # add county
-    for key, value in address_abbreviations.items():  # replace abbreviations
-        if key.search(new_address):
-            new_address = re.sub(key, " " + value + " ", new_address)
-    return new_address
+    return __replace_abbreviations(new_address)  # replace abbreviations
+
+
+canonical_abbreviations = {abbreviation.lower(): expansion.lower() for abbreviation, expansion in
+                           address_abbreviations.items()}
+canonical_unit_regex = re.compile(r'\b(?:apts?|apartments?|flts?|flats?|units?)\W+\d+\w?\b')
+canonical_number_regex = re.compile(r'\b(?:nos?|nums?|numbers?)\W+(?=\d)')
+canonical_token_regex = re.compile(r'[a-z0-9]+')
+canonical_district_regex = re.compile(r'\d+[a-z]?')
+
+
+@functools.lru_cache(maxsize=config['data_clean']['address']['cache-size'])
+def canonical_address_key(address: str) -> str:
+    """The key shared by the spellings of an address that geocode to the same place.
+
+    The address is lower cased and reduced to its words, with abbreviations expanded and St read as transform_address
+    reads it. A unit or apartment and its number are dropped, as the building is found either way, but a house number
+    is kept. County designators are dropped, as are county and postcode words at the end that repeat ones earlier in
+    the address, so a suffix added by transform_address doesn't change the key.
+    """
+    lowered = canonical_number_regex.sub(' ', canonical_unit_regex.sub(' ', address.lower().replace("'", "")))
+    tokens = []
+    for token in canonical_token_regex.findall(lowered):
+        token = canonical_abbreviations.get(token, token)
+        if token == 'st':
+            token = 'street' if len(tokens) != 0 and not tokens[-1].isdigit() else 'saint'
+        if token == 's' and len(tokens) != 0 and tokens[-1].isalpha():
+            tokens[-1] += token  # a possessive split from its word, as transform_address does to Anne's
+            continue
+        if token in ('co', 'county') or (len(tokens) != 0 and tokens[-1] == token and token.isalpha()):
+            continue
+        tokens.append(token)
+    while True:
+        if len(tokens) > 1 and tokens[-1].isalpha() and tokens[-1] in tokens[:-1]:
+            tokens.pop()  # a repeated county
+        elif len(tokens) > 3 and canonical_district_regex.fullmatch(tokens[-1]) and tokens[-2].isalpha() and \
+                any(tokens[position:position + 2] == tokens[-2:] for position in range(len(tokens) - 3)):
+            del tokens[-2:]  # a repeated postcode, e.g. Dublin 4
+        else:
+            break
+    return " ".join(tokens)
 
 
 class TransformedPropertySale:
+    __slots__ = ('app_id', 'date', 'address', 'postcode', 'county', 'price', 'full_price', 'vat_exclusive', 'new',
+                 'size')
 
     def __init__(self, app_id: str, date: datetime, address: str, postcode: str, county: str, price: Decimal,
                  full_price: bool, vat_exclusive: bool, new: bool, size: str):
@@ -129,7 +195,8 @@ class TransformedPropertySale:
 
     def json_serialise(self):
         fields = {}
-        for key, value in self.__dict__.items():
+        for key in self.__slots__:
+            value = getattr(self, key)
             if isinstance(value, (datetime.datetime, datetime.date)):
                 fields[key] = value.isoformat()
             elif isinstance(value, Decimal):
@@ -149,6 +216,18 @@ def transformed_from_raw(raw_property_sale: RawPropertySale) -> TransformedPrope
                raw_property_sale.not_full_price == "No", raw_property_sale.vat_exclusive == "Yes",
                raw_property_sale.property_description == "New Dwelling house /Apartment",
                transform_size_description(raw_property_sale.size_description))
-    logging.debug("{} - {} - {} - {} -> {} - {} - {} - {}".format(raw_property_sale.date, raw_property_sale.address,
-                  raw_property_sale.size_description, raw_property_sale.price, sale.date, sale.address, sale.size, sale.price))
     return sale
+
+
+def transformed_batch_from_raw(raw_property_sales: Iterable[RawPropertySale]) -> SalesBatch:
+    batch = SalesBatch()
+    for raw_property_sale in raw_property_sales:
+        batch.append_values(raw_property_sale.app_id, transform_date(raw_property_sale.date),
+                            transform_address(raw_property_sale.address, raw_property_sale.postcode,
+                                              raw_property_sale.county),
+                            raw_property_sale.postcode, raw_property_sale.county,
+                            transform_price(raw_property_sale.price),
+                            raw_property_sale.not_full_price == "No", raw_property_sale.vat_exclusive == "Yes",
+                            raw_property_sale.property_description == "New Dwelling house /Apartment",
+                            transform_size_description(raw_property_sale.size_description))
+    return batch
@@ -0,0 +1,12 @@
+from typing import Iterable, Iterator, List
+
+
+def batches(items: Iterable, batch_size: int) -> Iterator[List]:
+    batch = list()
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = list()
+    if len(batch) != 0:
+        yield batch
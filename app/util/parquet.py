@@ -0,0 +1,52 @@
+import logging
+import shutil
+from pathlib import Path
+from typing import List, Iterator
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from app import metrics
+
+
+def create_table(directory: str):
+    Path(directory).mkdir(parents=True, exist_ok=True)
+
+
+def drop_table(directory: str):
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def parts(directory: str) -> List[str]:
+    return sorted(str(part) for part in Path(directory).glob("part-*.parquet"))
+
+
+def append_table(directory: str, table: pa.Table, compression: str = 'snappy') -> str:
+    """Writes the table as the next part file of the directory, so earlier parts are never rewritten"""
+    part_file = "{}/part-{:05d}.parquet".format(directory.rstrip('/'), len(parts(directory)))
+    try:
+        pq.write_table(table, part_file, compression=compression)
+    except (IOError, pa.ArrowException):
+        logging.error("There was a problem writing '{}' rows to '{}'".format(table.num_rows, part_file))
+        raise
+    metrics.record_file(part_file)
+    logging.debug("Wrote '{}' rows to '{}'".format(table.num_rows, part_file))
+    return part_file
+
+
+def read_table(directory: str, schema: pa.Schema, columns: List[str] = None,
+               read_dictionary: List[str] = None) -> pa.Table:
+    # parts are memory mapped so only the selected column chunks are paged in
+    tables = [pq.read_table(part, columns=columns, memory_map=True, read_dictionary=read_dictionary)
+              for part in parts(directory)]
+    if len(tables) == 0:
+        empty = schema.empty_table()
+        return empty.select(columns) if columns else empty
+    return pa.concat_tables(tables)
+
+
+def stream_batches(directory: str, columns: List[str] = None, batch_size: int = 10000,
+                   read_dictionary: List[str] = None) -> Iterator[pa.RecordBatch]:
+    for part in parts(directory):
+        part_file = pq.ParquetFile(part, memory_map=True, read_dictionary=read_dictionary)
+        yield from part_file.iter_batches(batch_size=batch_size, columns=columns)
@@ -0,0 +1,82 @@
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import blake2b
+from pathlib import Path
+from typing import List, Dict
+
+import plotly
+import plotly.io as pio
+from plotly.offline import get_plotlyjs
+
+from app import metrics
+
+bundle_file = "plotly.min.js"
+manifest_file = "plots.json"
+
+
+def export_html(plots: List[Dict], output_path: str, shared_plotlyjs: bool = False, skip_unchanged: bool = False,
+                workers: int = 1) -> int:
+    """Writes each plot as HTML and returns how many were written.
+
+    With skip_unchanged a plot whose content hash matches the last export is skipped. With a shared plotly.js the
+    bundle is written once alongside the plots rather than embedded in every file.
+    """
+    include_plotlyjs = 'directory' if shared_plotlyjs else True
+    manifest = __read_manifest(output_path)
+    if manifest.get('plotly') != plotly.__version__:
+        manifest = {}
+        try:
+            Path(output_path + bundle_file).unlink()  # a bundle from another version of plotly
+        except FileNotFoundError:
+            pass
+    hashes = manifest.get('plots', {})
+    pending = []
+    for plot in plots:
+        figure_json = plot['figure'].to_json()
+        content_hash = blake2b((str(include_plotlyjs) + figure_json).encode('utf-8'), digest_size=16).hexdigest()
+        output_file = output_path + plot['name'] + ".html"
+        if skip_unchanged and hashes.get(plot['name']) == content_hash and Path(output_file).exists():
+            logging.debug("Plot '{}' is unchanged since the last export".format(plot['name']))
+            continue
+        hashes[plot['name']] = content_hash
+        pending.append((figure_json, output_file))
+    if shared_plotlyjs and len(pending) != 0 and not Path(output_path + bundle_file).exists():
+        # written here rather than by the first of several workers to find it missing
+        with open(output_path + bundle_file, 'w', encoding='utf-8') as file:
+            file.write(get_plotlyjs())
+        metrics.record_file(output_path + bundle_file)
+    if workers > 1 and len(pending) > 1:
+        # the workers re-import the main module when started by spawn or forkserver, so it needs a __main__ guard
+        with ProcessPoolExecutor(max_workers=min(workers, len(pending))) as executor:
+            list(executor.map(write_html, [figure for figure, _ in pending], [file for _, file in pending],
+                              [include_plotlyjs] * len(pending)))
+    else:
+        for figure_json, output_file in pending:
+            write_html(figure_json, output_file, include_plotlyjs)
+    for _, output_file in pending:
+        metrics.record_file(output_file)
+    __write_manifest(output_path, {'plotly': plotly.__version__, 'plots': hashes})
+    logging.debug("Wrote '{}' of '{}' plots to '{}'".format(len(pending), len(plots), output_path))
+    return len(pending)
+
+
+def write_html(figure_json: str, output_file: str, include_plotlyjs):
+    pio.from_json(figure_json).write_html(output_file, include_plotlyjs=include_plotlyjs)
+
+
+def __read_manifest(output_path: str) -> Dict:
+    try:
+        with open(output_path + manifest_file, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (IOError, ValueError):
+        return {}
+
+
+def __write_manifest(output_path: str, manifest: Dict):
+    try:
+        with open(output_path + manifest_file, 'w', encoding='utf-8') as file:
+            json.dump(manifest, file, indent=4)
+    except IOError:
+        logging.error("Unable to process file '{}'".format(output_path + manifest_file))
+        raise ValueError("There was an issue writing to the file '{}'".format(output_path + manifest_file))
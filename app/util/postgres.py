@@ -1,10 +1,15 @@
 import logging
-from typing import List
+import math
+import time
+from io import BytesIO
+from typing import List, Iterable, Iterator, Tuple
 
 from psycopg2 import sql, Error as PostgresError, DatabaseError
-from psycopg2.extensions import AsIs
+from psycopg2.extensions import AsIs, encodings
 from psycopg2.extras import execute_values
 
+from app import metrics
+
 
 def create_table(connection, name: str, metadata: List[str]):
     command = "CREATE TABLE IF NOT EXISTS %s (%s)"  # requires PostgreSQL >= 9.1
@@ -24,22 +29,147 @@ def read_all(connection, table_name: str):
     with connection, connection.cursor() as cursor:
         try:
             cursor.execute(command, [AsIs(table_name)])
+            metrics.increment('db_round_trips')
             return cursor.fetchall()
         except PostgresError:
             logging.error("There was a problem reading data from '{}'".format(table_name))
             raise
 
 
-def bulk_insert(connection, table_name: str, columns: List[str], values):
+def __missing_command(table_name: str, other_table_name: str, key: str) -> sql.Composed:
+    return sql.SQL("SELECT * FROM {0} WHERE NOT EXISTS (SELECT 1 FROM {1} WHERE {1}.{2} = {0}.{2})") \
+        .format(sql.Identifier(table_name), sql.Identifier(other_table_name), sql.Identifier(key))
+
+
+def stream_all(connection, table_name: str, columns: List[str] = None, itersize: int = 10000) -> Iterator[Tuple]:
+    selected = sql.SQL(', ').join(map(sql.Identifier, columns)) if columns else sql.SQL('*')
+    command = sql.SQL("SELECT {} FROM {}").format(selected, sql.Identifier(table_name))
+    return __stream(connection, command, table_name, itersize)
+
+
+def stream_all_missing(connection, table_name: str, other_table_name: str, key: str,
+                       itersize: int = 10000) -> Iterator[Tuple]:
+    return __stream(connection, __missing_command(table_name, other_table_name, key), table_name, itersize)
+
+
+def __stream(connection, command: sql.Composed, table_name: str, itersize: int) -> Iterator[Tuple]:
+    # a named cursor is held on the server so rows arrive itersize at a time rather than all at once
+    with connection, connection.cursor(name="stream_" + table_name) as cursor:
+        cursor.itersize = itersize
+        try:
+            cursor.execute(command)
+            count = 0
+            for row in cursor:
+                count += 1
+                if count % itersize == 0:
+                    metrics.increment('db_round_trips')
+                yield row
+            metrics.increment('db_round_trips', 2)  # the declare and the final partial fetch
+        except PostgresError:
+            logging.error("There was a problem streaming data from '{}'".format(table_name))
+            raise
+
+
+def bulk_insert(connection, table_name: str, columns: List[str], values, conflict_column: str = None,
+                returning: str = None):
     columns_joined = sql.SQL(', ').join(map(sql.Identifier, columns))
     command = sql.SQL("INSERT INTO {}({}) VALUES %s") \
         .format(sql.Identifier(table_name), columns_joined)
+    if conflict_column is not None:  # skip rows that are already stored
+        command += sql.SQL(" ON CONFLICT ({}) DO NOTHING").format(sql.Identifier(conflict_column))
+    if returning is not None:
+        command += sql.SQL(" RETURNING {}").format(sql.Identifier(returning))
+    count = [0]
+    start = time.perf_counter()
     with connection, connection.cursor() as cursor:
         try:
-            execute_values(cursor, command, values, page_size=1000)
+            stored = execute_values(cursor, command, __counted(values, count), page_size=1000,
+                                    fetch=returning is not None)
         except DatabaseError as error:
             logging.error("There was a problem persisting property sales '{}'", error.pgerror)
             raise
+    metrics.increment('db_round_trips', math.ceil(count[0] / 1000))
+    __log_throughput("Inserted", count[0], table_name, start)
+    return stored
+
+
+def copy_insert(connection, table_name: str, columns: List[str], values: Iterable, conflict_column: str = None,
+                returning: str = None, buffer_size: int = 8 * 1024 * 1024):
+    """Loads values with COPY FROM STDIN, flushing the CSV encoded rows whenever buffer_size bytes are buffered.
+
+    The CSV rather than the binary format is used, as binary would need every column type encoded by hand, numeric
+    in particular, for what is mostly short text. COPY cannot skip conflicts or return values itself so when either
+    is needed the rows are copied into a temporary staging table and inserted from there.
+    """
+    columns_joined = sql.SQL(', ').join(map(sql.Identifier, columns))
+    staged = conflict_column is not None or returning is not None
+    copy_table = sql.Identifier(table_name + "_staging" if staged else table_name)
+    copy_command = sql.SQL("COPY {}({}) FROM STDIN WITH (FORMAT csv)").format(copy_table, columns_joined)
+    count = 0
+    start = time.perf_counter()
+    with connection, connection.cursor() as cursor:
+        try:
+            if staged:
+                cursor.execute(sql.SQL("CREATE TEMPORARY TABLE {} ON COMMIT DROP AS SELECT {} FROM {} WITH NO DATA")
+                               .format(copy_table, columns_joined, sql.Identifier(table_name)))
+                metrics.increment('db_round_trips')
+            copy_command = copy_command.as_string(cursor)
+            encoding = encodings[connection.encoding]  # rows are sent as the bytes the server expects
+            buffer = BytesIO()
+            for value in values:
+                buffer.write((','.join(map(__csv_value, value)) + '\n').encode(encoding))
+                count += 1
+                if buffer.tell() >= buffer_size:
+                    __copy_buffer(cursor, copy_command, buffer)
+            __copy_buffer(cursor, copy_command, buffer)
+            stored = None
+            if staged:
+                command = sql.SQL("INSERT INTO {}({}) SELECT {} FROM {}") \
+                    .format(sql.Identifier(table_name), columns_joined, columns_joined, copy_table)
+                if conflict_column is not None:
+                    command += sql.SQL(" ON CONFLICT ({}) DO NOTHING").format(sql.Identifier(conflict_column))
+                if returning is not None:
+                    command += sql.SQL(" RETURNING {}").format(sql.Identifier(returning))
+                cursor.execute(command)
+                metrics.increment('db_round_trips')
+                stored = cursor.fetchall() if returning is not None else None
+        except DatabaseError as error:
+            logging.error("There was a problem copying property sales '{}'".format(error.pgerror))
+            raise
+    __log_throughput("Copied", count, table_name, start)
+    return stored
+
+
+def __copy_buffer(cursor, copy_command: str, buffer: BytesIO):
+    if buffer.tell() == 0:
+        return
+    metrics.increment('db_round_trips')
+    metrics.increment('db_bytes_copied', buffer.tell())
+    buffer.seek(0)
+    cursor.copy_expert(copy_command, buffer)
+    buffer.seek(0)
+    buffer.truncate()
+
+
+def __csv_value(value) -> str:
+    # an unquoted empty field is NULL in the CSV format so strings are always quoted
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def __counted(values: Iterable, count: List[int]):
+    for value in values:
+        count[0] += 1
+        yield value
+
+
+def __log_throughput(action: str, count: int, table_name: str, start: float):
+    elapsed = time.perf_counter() - start
+    logging.info("{} '{}' rows into '{}' in '{:.2f}'s ('{:.0f}' rows/sec)".format(
+        action, count, table_name, elapsed, count / elapsed if elapsed > 0 else 0))
 
 
 def run_command(connection, command: str, arguments: List,
@@ -47,6 +177,7 @@ def run_command(connection, command: str, arguments: List,
     with connection, connection.cursor() as cursor:
         try:
             cursor.execute(command, arguments)
+            metrics.increment('db_round_trips')
         except PostgresError:
             logging.error(error_message)
             logging.debug("Last command run: {}".format(cursor.mogrify(command, arguments)))
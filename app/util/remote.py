@@ -1,37 +1,132 @@
+import json
 import logging
-from io import BytesIO
+import os
 from pathlib import Path
-from typing import List
+from typing import List, Dict, Optional
 from zipfile import ZipFile, BadZipFile
 
 from requests import get, Response, RequestException
 
+validator_headers = {'etag': 'ETag', 'last-modified': 'Last-Modified'}
 
-def extract_remote_zip(url: str, output_directory, ssl_verify=True) -> List[str]:
-    zip_response = get_remote_zip(url, output_directory, ssl_verify)
-    zip_response.extractall(path=output_directory)
-    logging.debug("Extracted files '{}' to '{}'".format(zip_response.namelist(), output_directory))
-    return list(map(lambda zip_item: "{}/{}".format(output_directory, zip_item), zip_response.namelist()))
 
+def download_file(url: str, output_file: str, ssl_verify=True, conditional=True, chunk_size=1024 * 1024) -> bool:
+    """Streams the resource at url to output_file in chunks, resuming a partial download if one exists.
 
-def get_remote_zip(url: str, output_directory, ssl_verify=True):
-    logging.debug("Downloading zip file from '{}' to '{}'".format(url, output_directory))
-    Path(output_directory).mkdir(parents=True, exist_ok=True)
-    get_request = get_remote_resource(url, ssl_verify)
+    The ETag/Last-Modified validators are kept alongside the file and sent on the next request so that an
+    unchanged resource costs a single 304 response. Returns whether new content was written to output_file.
+    """
+    partial_file = output_file + ".part"
+    headers = {}
+    if Path(partial_file).exists() and __read_validators(partial_file):
+        resume_from = Path(partial_file).stat().st_size
+        partial_validators = __read_validators(partial_file)
+        headers['Range'] = "bytes={}-".format(resume_from)
+        headers['If-Range'] = partial_validators.get('etag') or partial_validators.get('last-modified')
+        logging.debug("Resuming download of '{}' from byte '{}'".format(url, resume_from))
+    elif conditional and Path(output_file).exists():
+        validators = __read_validators(output_file)
+        if 'etag' in validators:
+            headers['If-None-Match'] = validators['etag']
+        if 'last-modified' in validators:
+            headers['If-Modified-Since'] = validators['last-modified']
+    logging.debug("Downloading file from '{}' to '{}'".format(url, output_file))
+    Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+    with get_remote_resource(url, ssl_verify, headers=headers, stream=True) as response:
+        if response.status_code == 304:
+            logging.debug("Resource at '{}' is unchanged since the last download".format(url))
+            return False
+        if response.status_code == 416 and 'Range' in headers and __range_total(response) == resume_from:
+            # the last download stopped after the final chunk but before the file was moved into place
+            logging.debug("Partial download of '{}' is already complete".format(url))
+            written = 0
+        elif response.status_code == 416 and 'Range' in headers:
+            written = None
+        elif response.status_code == 206 and 'Range' in headers and __range_start(response) != resume_from:
+            # appending a range that does not start where the partial download ends would corrupt the file
+            logging.debug("Resource at '{}' was not sent from byte '{}'".format(url, resume_from))
+            written = None
+        else:
+            written = __write_response(url, response, partial_file, chunk_size)
+    if written is None:
+        # the partial download cannot be resumed from where it ends, so it is downloaded again from the start
+        logging.debug("Discarding the partial download of '{}'".format(url))
+        os.remove(partial_file)
+        os.remove(__validators_file(partial_file))
+        return download_file(url, output_file, ssl_verify, conditional, chunk_size)
+    os.replace(partial_file, output_file)
+    os.replace(__validators_file(partial_file), __validators_file(output_file))
+    logging.debug("Downloaded '{}' bytes from '{}' to '{}'".format(written, url, output_file))
+    return True
+
+
+def __write_response(url: str, response: Response, partial_file: str, chunk_size: int) -> int:
+    try:
+        response.raise_for_status()
+    except RequestException:
+        logging.error("There was a problem retrieving the resource at url '{}'".format(url))
+        raise
+    if response.status_code == 206:
+        mode = 'ab'
+    else:  # the server ignored the range, or there was nothing to resume
+        mode = 'wb'
+        __write_validators(partial_file, response)
+    written = 0
+    with open(partial_file, mode) as file:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            file.write(chunk)
+            written += len(chunk)
+    return written
+
+
+def __range_start(response: Response) -> Optional[int]:
+    # a partial response names the bytes sent, i.e. Content-Range: bytes start-end/length
+    start = response.headers.get('Content-Range', '').partition(' ')[2].partition('-')[0]
+    return int(start) if start.isdigit() else None
+
+
+def __range_total(response: Response) -> Optional[int]:
+    # an unsatisfiable range is answered with the full length of the resource, i.e. Content-Range: bytes */length
+    total = response.headers.get('Content-Range', '').rpartition('/')[2]
+    return int(total) if total.isdigit() else None
+
+
+def __validators_file(file: str) -> str:
+    return file + ".json"
+
+
+def __read_validators(file: str) -> Dict[str, str]:
+    try:
+        with open(__validators_file(file), 'r', encoding='utf-8') as validators:
+            return json.load(validators)
+    except (IOError, ValueError):
+        return {}
+
+
+def __write_validators(file: str, response: Response):
+    validators = {key: response.headers[header] for key, header in validator_headers.items()
+                  if header in response.headers}
+    with open(__validators_file(file), 'w', encoding='utf-8') as output:
+        json.dump(validators, output)
+
+
+def extract_zip(zip_file: str, output_directory) -> List[str]:
     try:
-        zip_response = ZipFile(BytesIO(get_request.content))
+        with ZipFile(zip_file) as archive:
+            archive.extractall(path=output_directory)
+            names = archive.namelist()
     except BadZipFile:
-        logging.error("Unable to process resource from '{}' as a zip file".format(url))
+        logging.error("Unable to process file '{}' as a zip file".format(zip_file))
         raise
-    logging.debug("Downloaded zip file from '{}' to '{}'".format(url, output_directory))
-    return zip_response
+    logging.debug("Extracted files '{}' to '{}'".format(names, output_directory))
+    return list(map(lambda zip_item: "{}/{}".format(output_directory, zip_item), names))
 
 
-def get_remote_resource(url: str, ssl_verify=True) -> Response:
+def get_remote_resource(url: str, ssl_verify=True, headers=None, stream=False) -> Response:
     if not ssl_verify:
         logging.debug("Request is not verify SSL certificate")
     try:
-        request = get(url, verify=ssl_verify)
+        request = get(url, verify=ssl_verify, headers=headers, stream=stream)
     except RequestException:
         logging.error("There was a problem retrieving the resource at url '{}'".format(url))
         raise
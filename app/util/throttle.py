@@ -0,0 +1,27 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Thread safe token bucket allowing rate acquisitions a second on average and bursts of up to capacity.
+
+    Callers that find the bucket empty reserve the next token and sleep until it is due, so waiting threads are let
+    through in the order they arrived rather than all retrying at once.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
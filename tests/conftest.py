@@ -0,0 +1,18 @@
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+root = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(root))
+
+# the app reads its config and secrets from, and creates its output directories under, the working directory
+working_directory = Path(tempfile.mkdtemp(prefix="property-sales-tests-"))
+(working_directory / "resources").mkdir()
+shutil.copy(str(root / "resources" / "config.yaml"), str(working_directory / "resources" / "config.yaml"))
+if (root / "resources" / "secrets.yaml").exists():
+    shutil.copy(str(root / "resources" / "secrets.yaml"), str(working_directory / "resources" / "secrets.yaml"))
+else:
+    (working_directory / "resources" / "secrets.yaml").write_text("{}\n")
+os.chdir(str(working_directory))
@@ -0,0 +1,81 @@
+import copy
+import threading
+from typing import Dict, List
+
+
+class FakeCollection:
+    """The part of a pymongo collection the geocoder uses, holding its documents in memory.
+
+    Filters are equality on (dotted) fields, null matching a missing field, and $or and $in of those. Every bulk
+    write is recorded, as are the filters of its updates.
+    """
+    name = "fake"
+
+    def __init__(self, documents: List[Dict]):
+        self.documents = [copy.deepcopy(document) for document in documents]
+        self.writes = []
+        self.lock = threading.Lock()
+
+    def create_index(self, keys, **kwargs):
+        pass
+
+    def index_information(self) -> Dict:
+        return {}
+
+    def count_documents(self, query: Dict) -> int:
+        return sum(1 for document in self.documents if _matches(document, query))
+
+    def find(self, query: Dict, projection: Dict = None, **kwargs):
+        with self.lock:
+            found = [copy.deepcopy(document) for document in self.documents if _matches(document, query)]
+        return iter([_project(document, projection) for document in found])
+
+    def bulk_write(self, operations, ordered=True):
+        with self.lock:
+            self.writes.append([operation._filter for operation in operations])
+            for operation in operations:
+                many = type(operation).__name__ == 'UpdateMany'
+                for document in [document for document in self.documents if _matches(document, operation._filter)]:
+                    for field, value in operation._doc['$set'].items():
+                        _set(document, field, value)
+                    if not many:
+                        break
+
+
+def _get(document: Dict, field: str):
+    for part in field.split('.'):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(part)
+    return document
+
+
+def _set(document: Dict, field: str, value):
+    parts = field.split('.')
+    for part in parts[:-1]:
+        document = document.setdefault(part, {})
+    document[parts[-1]] = value
+
+
+def _matches(document: Dict, query: Dict) -> bool:
+    for field, condition in query.items():
+        if field == '$or':
+            if not any(_matches(document, alternative) for alternative in condition):
+                return False
+        elif isinstance(condition, dict) and '$in' in condition:
+            if _get(document, field) not in condition['$in']:
+                return False
+        elif _get(document, field) != condition:
+            return False
+    return True
+
+
+def _project(document: Dict, projection: Dict) -> Dict:
+    if projection is None:
+        return document
+    projected = {}
+    for field, included in projection.items():
+        value = _get(document, field)
+        if included and value is not None:
+            _set(projected, field, value)
+    return projected
@@ -0,0 +1,64 @@
+import copy
+import csv
+
+import pytest
+
+import app.cleaner as cleaner
+from app.benchmark import synthetic
+from app.property_price_register import RawPropertySale
+from app.sanitiser import Sanitiser
+
+edge_cases = [
+    ["01/01/2010", "Apt 4, 12 Main St, Co. Dublin", "Baile Átha Cliath 6", "Dublin", "€250,000.00", "No", "No",
+     "Teach/Árasán Cónaithe Nua", "níos lú ná 38 méadar cearnach"],
+    ["31/12/2020", "1, 2, 3 And 5 CHURCH RD", "Dublin 6w", "Dublin", "€1,234,567.89", "Yes", "Yes",
+     "New Dwelling house /Apartment", "greater than or equal to 125 sq metres"],
+    ["29/02/2016", "St. Anne's, Oak Ave, Naas", "Ní Bhaineann", "Kildare", "€5,000.00", "No", "Yes",
+     "Teach/Árasán Cónaithe Atháimhe", "greater than 125 sq metres"],
+    ["15/06/2013", "   flat 2 the mill, kilbride", "", "Wicklow", "€99,999.99", "Yes", "No",
+     "Second-Hand Dwelling house /Apartment", ""],
+    ["15/06/2013", "   flat 2 the mill, kilbride", "", "Wicklow", "€99,999.99", "Yes", "No",
+     "Second-Hand Dwelling house /Apartment", ""],
+    # sanitises to the postcode of the first, so the two raw postcodes share a code
+    ["01/01/2010", "Apt 5, 12 Main St, Co. Dublin", "Dublin 6", "Dublin", "€250,000.00", "No", "No",
+     "New Dwelling house /Apartment", "less than 38 sq metres"],
+    ["07/08/2019", "No. 7 Harbour View", "Dublin 24", "Dublin", "€310,000.00", "No", "No",
+     "Second-Hand Dwelling house /Apartment", "less than 38 sq metres"],
+    # values the sanitiser records as anomalies
+    ["02/03/2018", "9 Mill Lane, Cork", "Cork 1", "Cork", "310000.00", "No", "No", "Bungalow", "huge"],
+]
+
+
+def synthetic_sales(tmp_path, rows: int):
+    register = tmp_path / "register.csv"
+    synthetic.generate_csv(str(register), rows, seed=7)
+    with open(str(register), 'r', encoding='cp1252') as file:
+        reader = csv.reader(file)
+        next(reader)
+        return [RawPropertySale(*row[:9]) for row in reader]
+
+
+def clean_with(engine: str, sales, sanitise: bool):
+    Sanitiser.anomalies.clear()
+    batch = cleaner.clean_chunk(copy.deepcopy(sales), sanitise, engine)  # the row engine updates sales in place
+    anomalies = dict(Sanitiser.anomalies)
+    Sanitiser.anomalies.clear()
+    return batch, anomalies
+
+
+@pytest.mark.parametrize("sanitise", [True, False])
+def test_engines_agree_on_synthetic_register(tmp_path, sanitise):
+    sales = synthetic_sales(tmp_path, 5000)
+    row, row_anomalies = clean_with('row', sales, sanitise)
+    columnar, columnar_anomalies = clean_with('columnar', sales, sanitise)
+    assert list(columnar) == list(row)
+    assert columnar_anomalies == row_anomalies
+
+
+def test_engines_agree_on_edge_cases():
+    sales = [RawPropertySale(*row) for row in edge_cases]
+    row, row_anomalies = clean_with('row', sales, True)
+    columnar, columnar_anomalies = clean_with('columnar', sales, True)
+    assert list(columnar) == list(row)
+    assert columnar_anomalies == row_anomalies
+    assert len(row_anomalies) == 4
@@ -0,0 +1,156 @@
+import time
+
+import pytest
+from geopy import Location
+
+import app.geocoder as geocoder
+from app import config
+from app.benchmark import geocoding_server
+from app.benchmark.geocoding_server import NominatimStandIn
+from app.geocoding.nominatim import Nominatim
+from app.geocoding.provider import Provider
+from fake_mongo import FakeCollection
+
+
+class DelayedProvider(Provider):
+    """Answers every address with the same location after a delay, recording when each was requested"""
+
+    def __init__(self, identifier: str, delay: float):
+        self.name = identifier
+        self.delay = delay
+        self.requests = []
+
+    def raw_location_keys(self):
+        return ()
+
+    def max_requests(self) -> int:
+        return -1
+
+    def identifier(self) -> str:
+        return self.name
+
+    def geocode(self, address) -> Location:
+        self.requests.append((time.monotonic(), address))
+        time.sleep(self.delay)
+        return Location(address, (53.3, -6.2, 0), {})
+
+
+def addresses(count: int, spellings: int = 1):
+    return [{'address': "{} Main Street".format(number), 'key': "{} main street".format(number // spellings),
+             'geocoded': {}} for number in range(count)]
+
+
+@pytest.fixture
+def collection(monkeypatch):
+    def create(documents):
+        fake = FakeCollection(documents)
+        monkeypatch.setattr(geocoder, 'collection', fake)
+        return fake
+    return create
+
+
+@pytest.fixture
+def providers(monkeypatch):
+    def create(*delays, concurrency=4, backlog=5):
+        monkeypatch.setitem(config['geocoding'], 'flush-count', 1000)
+        monkeypatch.setitem(config['geocoding'], 'fan-out', {'enabled': True, 'backlog': backlog})
+        created = []
+        for number, delay in enumerate(delays):
+            identifier = "provider{}".format(number)
+            monkeypatch.setitem(config['geocoders'], identifier,
+                                {'concurrency': concurrency, 'requests-per-second': -1})
+            created.append(DelayedProvider(identifier, delay))
+        return created
+    return create
+
+
+def test_fan_out_stores_every_provider_with_one_update_per_key(collection, providers):
+    fake = collection(addresses(40, spellings=2))
+    first, second = providers(0.001, 0.002, backlog=100)
+    assert geocoder.geocode_all([first, second]) == {'provider0': 20, 'provider1': 20}
+    updated = [key for write in fake.writes for key in write]
+    assert len(updated) == 20 and len(set(map(str, updated))) == 20
+    for document in fake.documents:
+        assert {'provider0', 'provider0_processed', 'provider1', 'provider1_processed'} <= set(document['geocoded'])
+
+
+def test_fan_out_walks_past_a_slow_provider(collection, providers):
+    fake = collection(addresses(60))
+    fast, slow = providers(0.001, 0.1, concurrency=1, backlog=3)
+    start = time.monotonic()
+    counts = geocoder.geocode_all([fast, slow])
+    assert counts['provider0'] == 60 and counts['provider1'] < 10
+    # the fast provider finished while the slow one was still on its first few addresses
+    assert fast.requests[-1][0] - start < slow.delay * 3
+    # those the slow provider was passed over for are left for the next run
+    assert sum(1 for document in fake.documents if 'provider1_processed' not in document['geocoded']) == \
+        60 - counts['provider1']
+
+
+def test_fan_out_skips_what_each_provider_has_processed(collection, providers):
+    documents = addresses(10)
+    for document in documents[:6]:
+        document['geocoded']['provider0_processed'] = 1
+    collection(documents)
+    first, second = providers(0, 0, backlog=100)
+    assert geocoder.geocode_all([first, second]) == {'provider0': 4, 'provider1': 10}
+    assert sorted(address for _, address in first.requests) == sorted(d['address'] for d in documents[6:])
+
+
+@pytest.fixture
+def nominatim(monkeypatch):
+    """A Nominatim provider searching a local stand-in server, set up by the returned function"""
+    servers = []
+
+    def create(latency=0.01, quota=-1, concurrency=4, requests_per_second=-1, max_requests=-1, flush_count=1000):
+        server = geocoding_server.serve(0, latency, quota)
+        servers.append(server)
+        monkeypatch.setitem(config['geocoding'], 'flush-count', flush_count)
+        for key, value in [('domain', "localhost:{}".format(server.server_address[1])), ('scheme', "http"),
+                           ('concurrency', concurrency), ('requests-per-second', requests_per_second),
+                           ('max-requests', max_requests)]:
+            monkeypatch.setitem(config['geocoders']['nominatim'], key, value)
+        return Nominatim()
+    yield create
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_geocode_requests_each_key_once_and_stores_it_with_one_update(collection, nominatim):
+    fake = collection(addresses(40, spellings=2))
+    assert geocoder.geocode(nominatim()) == 20
+    assert NominatimStandIn.requests == 20
+    updated = [key for write in fake.writes for key in write]
+    assert len(updated) == 20 and len(set(map(str, updated))) == 20
+    assert all('nominatim_processed' in document['geocoded'] for document in fake.documents)
+
+
+def test_geocode_writes_every_flush_count(collection, nominatim):
+    fake = collection(addresses(10))
+    assert geocoder.geocode(nominatim(flush_count=3)) == 10
+    assert [len(write) for write in fake.writes] == [3, 3, 3, 1]
+
+
+def test_geocode_keeps_to_the_requests_per_second(collection, nominatim):
+    collection(addresses(11))
+    provider = nominatim(latency=0, concurrency=4, requests_per_second=20)
+    start = time.monotonic()
+    assert geocoder.geocode(provider) == 11
+    # the first request is let through at once, each of the other ten waits its turn
+    assert time.monotonic() - start >= 10 / 20 * 0.9
+
+
+def test_geocode_stops_at_max_requests(collection, nominatim):
+    fake = collection(addresses(20))
+    assert geocoder.geocode(nominatim(max_requests=5)) == 5
+    assert NominatimStandIn.requests == 5
+    assert sum(1 for document in fake.documents if 'nominatim_processed' in document['geocoded']) == 5
+
+
+def test_geocode_stops_once_the_quota_is_exceeded(collection, nominatim):
+    fake = collection(addresses(20))
+    assert geocoder.geocode(nominatim(quota=3, concurrency=1)) == 3
+    # the request refused for the quota is the last one made, those answered before it are still stored
+    assert NominatimStandIn.requests == 4
+    assert sum(1 for document in fake.documents if 'nominatim_processed' in document['geocoded']) == 3
@@ -0,0 +1,33 @@
+import csv
+
+from app import property_price_register
+
+header = ["Date of Sale (dd/mm/yyyy)", "Address", "Postal Code", "County", "Price (€)", "Not Full Market Price",
+          "VAT Exclusive", "Description of Property", "Property Size Description"]
+sale = ["01/02/2020", "1 Main Street, Ennis", "", "Clare", "€200,000.00", "No", "No",
+        "Second-Hand Dwelling house /Apartment", ""]
+other_sale = ["03/02/2020", "2 Main Street, Ennis", "", "Clare", "€210,000.00", "No", "No",
+              "Second-Hand Dwelling house /Apartment", ""]
+
+
+def read(tmp_path, monkeypatch, rows):
+    register = tmp_path / "register.csv"
+    with open(str(register), 'w', encoding="cp1252", newline='') as file:
+        csv.writer(file).writerows([header] + rows)
+    monkeypatch.setattr(property_price_register, 'output_file', str(register))
+    return property_price_register.parse_csv()
+
+
+def test_identical_rows_have_their_own_keys(tmp_path, monkeypatch):
+    sales = read(tmp_path, monkeypatch, [sale, sale, other_sale])
+    assert len(set(sale.app_id for sale in sales)) == 3
+
+
+def test_identical_rows_out_of_date_order_have_their_own_keys(tmp_path, monkeypatch):
+    sales = read(tmp_path, monkeypatch, [sale, other_sale, sale])
+    assert len(set(sale.app_id for sale in sales)) == 3
+
+
+def test_keys_are_the_same_every_read(tmp_path, monkeypatch):
+    first = [sale.app_id for sale in read(tmp_path, monkeypatch, [sale, other_sale, sale])]
+    assert [sale.app_id for sale in read(tmp_path, monkeypatch, [sale, other_sale, sale])] == first
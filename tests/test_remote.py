@@ -0,0 +1,123 @@
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from app.util import remote
+
+content = bytes(range(256)) * 40
+etag = '"register-v1"'
+
+
+class RegisterStandIn(BaseHTTPRequestHandler):
+    """Serves content with an ETag, honouring If-None-Match, and Range when If-Range matches"""
+    requests = []
+    # when set, a range is answered from this byte whichever was requested
+    range_start = None
+
+    def do_GET(self):
+        RegisterStandIn.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        requested_range = self.headers.get('Range')
+        if requested_range is not None and self.headers.get('If-Range') == etag:
+            start = int(requested_range[len("bytes="):-1])
+            if RegisterStandIn.range_start is not None:
+                start = RegisterStandIn.range_start
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header('Content-Range', "bytes */{}".format(len(content)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.__send(206, content[start:], {'Content-Range': "bytes {}-{}/{}".format(
+                start, len(content) - 1, len(content))})
+            return
+        self.__send(200, content, {})
+
+    def __send(self, status: int, body: bytes, headers):
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def url():
+    server = ThreadingHTTPServer(('localhost', 0), RegisterStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://localhost:{}/PPR-ALL.zip".format(server.server_address[1])
+    server.shutdown()
+
+
+@pytest.fixture
+def output_file(tmp_path):
+    RegisterStandIn.requests.clear()
+    yield str(tmp_path / "PPR-ALL.zip")
+    RegisterStandIn.range_start = None
+
+
+def write_partial(output_file: str, partial: bytes, validators):
+    with open(output_file + ".part", 'wb') as file:
+        file.write(partial)
+    with open(output_file + ".part.json", 'w', encoding='utf-8') as file:
+        json.dump(validators, file)
+
+
+def read(file: str) -> bytes:
+    with open(file, 'rb') as downloaded:
+        return downloaded.read()
+
+
+def test_downloads_the_whole_resource(url, output_file):
+    assert remote.download_file(url, output_file, chunk_size=1000)
+    assert read(output_file) == content
+    with open(output_file + ".json", 'r', encoding='utf-8') as validators:
+        assert json.load(validators) == {'etag': etag}
+
+
+def test_unchanged_resource_is_not_downloaded_again(url, output_file):
+    remote.download_file(url, output_file)
+    assert not remote.download_file(url, output_file)
+    assert RegisterStandIn.requests[-1]['If-None-Match'] == etag
+    assert read(output_file) == content
+
+
+def test_resumes_a_partial_download(url, output_file):
+    write_partial(output_file, content[:3000], {'etag': etag})
+    assert remote.download_file(url, output_file)
+    assert RegisterStandIn.requests[-1]['Range'] == "bytes=3000-"
+    assert read(output_file) == content
+
+
+def test_complete_partial_download_is_kept(url, output_file):
+    write_partial(output_file, content, {'etag': etag})
+    assert remote.download_file(url, output_file)
+    assert len(RegisterStandIn.requests) == 1
+    assert read(output_file) == content
+
+
+def test_partial_download_longer_than_the_resource_is_discarded(url, output_file):
+    write_partial(output_file, content + b"stale", {'etag': etag})
+    assert remote.download_file(url, output_file)
+    assert len(RegisterStandIn.requests) == 2
+    assert 'Range' not in RegisterStandIn.requests[-1]
+    assert read(output_file) == content
+
+
+def test_partial_download_is_restarted_when_the_range_sent_starts_elsewhere(url, output_file):
+    write_partial(output_file, content[:3000], {'etag': etag})
+    RegisterStandIn.range_start = 1000
+    assert remote.download_file(url, output_file)
+    assert len(RegisterStandIn.requests) == 2
+    assert 'Range' not in RegisterStandIn.requests[-1]
+    assert read(output_file) == content
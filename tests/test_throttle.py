@@ -0,0 +1,41 @@
+import threading
+import time
+
+from app.util.throttle import TokenBucket
+
+
+def timed(function) -> float:
+    start = time.monotonic()
+    function()
+    return time.monotonic() - start
+
+
+def test_acquisitions_are_spaced_at_the_rate():
+    bucket = TokenBucket(20)
+    assert timed(lambda: [bucket.acquire() for _ in range(11)]) >= 10 / 20 * 0.9
+
+
+def test_a_full_bucket_lets_a_burst_through_at_once():
+    bucket = TokenBucket(5, capacity=5)
+    assert timed(lambda: [bucket.acquire() for _ in range(5)]) < 0.1
+    assert timed(bucket.acquire) >= 1 / 5 * 0.9
+
+
+def test_the_rate_is_shared_between_threads():
+    bucket = TokenBucket(40)
+
+    def acquire_all():
+        threads = [threading.Thread(target=lambda: [bucket.acquire() for _ in range(5)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert timed(acquire_all) >= 19 / 40 * 0.9
+
+
+def test_tokens_build_up_while_idle():
+    bucket = TokenBucket(10, capacity=3)
+    for _ in range(3):
+        bucket.acquire()
+    time.sleep(0.3)
+    assert timed(lambda: [bucket.acquire() for _ in range(3)]) < 0.1
@@ -0,0 +1,53 @@
+import pytest
+
+from app.transformer import canonical_address_key, transform_address
+
+
+@pytest.mark.parametrize("address, variant", [
+    ("Apt 4, 12 Main St", "12 Main Street"),
+    ("Apt. 4 12 Main St", "12 Main Street"),
+    ("Flat 2 12 Main Street Dublin 4", "12 Main St, Dublin 4"),
+    ("12 Main Street Dublin 4 Dublin", "12 Main Street Dublin 4"),
+    ("12 Main Street Dublin Dublin 4 Dublin", "12 Main Street, Co. Dublin, Dublin 4"),
+    ("9 Mill Ln Cork Cork", "9 Mill Lane, Co. Cork"),
+    ("No. 7 Harbour Vw", "7 Harbour View"),
+    ("St Annes Park", "Saint Annes Park"),
+    ("St. Anne's Park", "Saint Annes Park"),
+    ("12 St Patricks Rd", "12 Saint Patricks Road"),
+    ("1 Oak Ave", "1 OAK AVENUE"),
+])
+def test_variants_share_a_key(address, variant):
+    assert canonical_address_key(address) == canonical_address_key(variant)
+
+
+@pytest.mark.parametrize("address, other", [
+    ("12 Church View Church Road", "12 Church View Road"),
+    ("12 Main Street", "14 Main Street"),
+    ("4 Main Street Dublin 4", "4 Main Street Dublin"),
+    ("12 Main Street Dublin 4", "12 Main Street Dublin 6"),
+    ("12 Main Street Cork", "12 Main Street Kerry"),
+    ("12 Dublin Road Cork", "12 Cork Road Dublin"),
+])
+def test_different_addresses_keep_their_own_key(address, other):
+    assert canonical_address_key(address) != canonical_address_key(other)
+
+
+@pytest.mark.parametrize("address, postcode, county, variant", [
+    ("12 Main St", "Dublin 4", "Dublin", "12 Main Street, Dublin 4, Co. Dublin"),
+    ("St. Anne's, Oak Ave", "", "Kildare", "Saint Annes, Oak Avenue, Co. Kildare"),
+    ("1 Mill Ln, Co. Cork", "", "Cork", "1 Mill Lane Cork"),
+])
+def test_transformed_addresses_share_a_key_with_their_variants(address, postcode, county, variant):
+    transformed = transform_address(address, postcode, county)
+    assert canonical_address_key(transformed) == canonical_address_key(transform_address(variant, postcode, county))
+
+
+@pytest.mark.parametrize("address, transformed", [
+    ("Main St St Annes", "Main Street St Annes Dublin"),
+    ("12 St St Annes", "12 St Street Annes Dublin"),
+    ("Oak Sq Sq Park", "Oak Square Sq Park Dublin"),
+    ("Oak Rd Rd Rd Park", "Oak Road Rd Road Park Dublin"),
+    ("Oak Ave Rd Park", "Oak Avenue Road Park Dublin"),
+])
+def test_repeated_abbreviations_expand_as_one_pass_for_each_would(address, transformed):
+    assert transform_address(address, "", "Dublin") == transformed